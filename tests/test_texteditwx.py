@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+texteditwx = pytest.importorskip("texteditwx")  # wxPythonなどが必要
+
+
+def brute_search_backward(engine, v, end, start=0):
+    # endより前で始まる，searchで見つかる最後のもの
+    last = None
+    for pos in range(start, end):
+        f = engine.search(v, pos, end)
+        if f is not None and f[0] < end and (last is None or f[0] > last):
+            last = f[0]
+    return None if last is None else engine.search(v, last, end)
+
+
+def test_search_backward_random():
+    rnd = random.Random(0)
+    for n in range(300):
+        rows = []
+        for k in range(rnd.randint(1, 4)):
+            if rnd.random() < 0.5:
+                find = "".join(rnd.choice("ab") for i in range(rnd.randint(1, 3)))
+                rows.append([True, False, find, None])
+            else:
+                find = rnd.choice(["a+", "b?a", r"\bab\b", "(ab)+", "^b", "a$", "x?"])
+                rows.append([True, True, find, None])
+        engine = texteditwx.FindEngine(rows, 1, 2, rnd.random() < 0.3)
+        v = "".join(rnd.choice("abAB \n") for i in range(rnd.randint(0, 2000)))
+        for i in range(5):
+            end = rnd.randint(0, len(v))
+            start = rnd.randint(0, end)
+            assert engine.search_backward(v, end, start) == brute_search_backward(
+                engine, v, end, start
+            )
+
+
+def test_search_backward_far_match():
+    # 見つかるまで範囲を広げても，手前で見つかったものを返す
+    engine = texteditwx.FindEngine(
+        [[True, False, "ab", None], [True, True, r"\bERROR\b", None]], 1, 2, False
+    )
+    v = "ERROR " + "x" * 100000 + "ab" + "y" * 100000
+    assert engine.search_backward(v, len(v)) == [100006, 100008, engine.rows[0]]
+    assert engine.search_backward(v, 100007) == [0, 5, engine.rows[1]]
+
+
+def test_schedule_blocks_long_chain():
+    # 前のブロックの記号で次の記号を定義する長い鎖でも，再帰の上限に達しない
+    n = 3000
+    commands = ["a0:1;"] + ["a{}:a{}+1;".format(i, i - 1) for i in range(1, n)]
+    dependencies = texteditwx.block_dependencies(commands)
+    definers = dict(("a{}".format(i), "old") for i in range(n))
+    order = texteditwx.schedule_blocks([n - 1], dependencies, definers)
+    assert [i for i, kills in order] == list(range(n))
+
+
+def test_schedule_blocks_diamond():
+    # 2つの変更されたブロックが同じブロックに依存しても，一度だけ並べる
+    commands = ["a:1;", "b:a+1;", "c:a+2;", "d:b+c;"]
+    dependencies = texteditwx.block_dependencies(commands)
+    definers = {"a": "old", "b": "old", "c": "old"}
+    order = texteditwx.schedule_blocks([1, 2, 3], dependencies, definers)
+    assert [i for i, kills in order] == [0, 1, 2, 3]
+    order = texteditwx.schedule_blocks([3, 2, 1], dependencies, definers)
+    order = [i for i, kills in order]
+    assert sorted(order) == [0, 1, 2, 3]
+    for i in (1, 2):
+        assert order.index(0) < order.index(i) < order.index(3)
+
+
+def test_schedule_blocks_kill():
+    # 文書で定義されていない記号がMaximaに残っていれば消す
+    dependencies = texteditwx.block_dependencies(["x+1;"])
+    order = texteditwx.schedule_blocks([0], dependencies, {"x": "old"})
+    assert order == [[0, "kill(x)$"]]
+
+
+@pytest.mark.parametrize(
+    "s, expected",
+    [
+        ("a+(-b)", "a-b"),
+        ("a+-b", "a-b"),
+        ("a-(-b)", "a+b"),
+        ("a--b", "a+b"),
+        ("a+-(b+c)", "a-(b+c)"),
+        ("a*(-b)", "a*(-b)"),
+        ("((a+b))+c", "a+b+c"),
+        ("a-(b+c)", "a-(b+c)"),
+        ("a/(b/c)", "a/(b/c)"),
+        ("(a^b)^c", "(a^b)^c"),
+        ("(n!)!", "(n!)!"),
+        ("a^-(b+c)", "a^-(b+c)"),
+        ("-(a+b)", "-(a+b)"),
+        ("-(a*b)", "-(a*b)"),
+        ("(a+b)*c", "(a+b)*c"),
+        ("f(a+b)*c", "f(a+b)*c"),
+        ("[(a+b)*c,d]", "[(a+b)*c,d]"),
+        ("(x)", "x"),
+    ],
+)
+def test_minimize_parentheses(s, expected):
+    assert texteditwx.minimize_parentheses(s) == expected
+
+
+def test_strip_label_numbers():
+    last_input, outputs = texteditwx.strip_label_numbers(
+        "/* (%i3): */",
+        ["/* (%o3): */\nx+1", "/* PRINT: */\nx\n\n/* (%o4): */\ndone"],
+    )
+    assert last_input == "/* (%i): */"
+    assert outputs == ["/* (%o): */\nx+1", "/* PRINT: */\nx\n\n/* (%o): */\ndone"]
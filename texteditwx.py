@@ -34,6 +34,24 @@ import requests
 import zenhan
 import ast
 import webbrowser
+import threading
+import time
+import multiprocessing
+import tempfile
+import hashlib
+import collections
+import zlib
+import bisect
+import heapq
+import mmap
+import fnmatch
+import difflib
+import itertools
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
 
 if sys.platform != "darwin":
     import locale  # required for a format '%p' (AM/PM) in strftime
@@ -66,14 +84,19 @@ def encode_if_necessary(s):
 # (5) Edit locale/en/LC_MESSAGES/messages.po
 # (6) msgfmt -o locale/en/LC_MESSAGES/messages.mo locale/en/LC_MESSAGES/messages.po
 #     - Reverse opetration can be done by 'msgunfmt'
-gettext.translation(
-    domain="messages",
-    localedir=os.path.join(
-        os.path.dirname(os.path.realpath(decode_if_necessary(__file__))), "locale"
-    ),
-    languages=languages,
-    fallback=True,
-).install()
+def install_translation(languages):
+    # _()を使えるようにする．ファイルを検索するプロセスでも呼ぶ
+    gettext.translation(
+        domain="messages",
+        localedir=os.path.join(
+            os.path.dirname(os.path.realpath(decode_if_necessary(__file__))), "locale"
+        ),
+        languages=languages,
+        fallback=True,
+    ).install()
+
+
+install_translation(languages)
 
 if sys.platform == "darwin":
     import unicodedata
@@ -172,171 +195,394 @@ def correct_file_name_in_unicode(file_name):
 
 
 def str_diff(str1, str2):
-    if str1 == "" or str2 == "":
-        return [0, str1, str2]
+    # 4096文字ずつ比べて，違う所だけ1文字ずつ比べる
     l1 = len(str1)
     l2 = len(str2)
+    l = min(l1, l2)
     i = 0
-    while str1[i] == str2[i]:
+    while i < l and str1[i : i + 4096] == str2[i : i + 4096]:
+        i += 4096
+    i = min(i, l)
+    while i < l and str1[i] == str2[i]:
         i += 1
-        if i == l1:
-            return [i, "", str2[i:]]
-        elif i == l2:
-            return [i, str1[i:], ""]
-    j = -1
-    while str1[j] == str2[j]:
-        if l1 + j == i:
-            return [i, "", str2[i:j]]
-        elif l2 + j == i:
-            return [i, str1[i:j], ""]
-        j -= 1
-    j += 1
-    return [i, str1[i : l1 + j], str2[i : l2 + j]]  # j < 0
-
-
-def str_range_between(string, selection, parentheses):
-    # example of parentheses: (('(', ')'), ('{', '}'), ('[', ']'))
-    if not isinstance(parentheses[0], (tuple, list)):
-        parentheses = (parentheses,)
-    w = max([max(len(i[0] or ""), len(i[1] or "")) for i in parentheses])
-    l0 = selection[0] - 1
-    pair = None
-    stack = []
-    while (
-        l0 >= 0
-    ):  # 左に移動して，かっこの始まりを見つけて対応する終わりをpairに格納する．
-        s = string[l0 : l0 + w]  # はみ出した範囲のぶんは空文字になる．
-        p0 = next((i[0] for i in parentheses if s.startswith(i[1])), None)
-        if p0 is not None:
-            stack.append(p0)
+    j = 0  # 末尾の共通部分の長さ
+    while j < l - i:
+        k = min(4096, l - i - j)
+        if str1[l1 - j - k : l1 - j] != str2[l2 - j - k : l2 - j]:
+            break
+        j += k
+    while j < l - i and str1[l1 - j - 1] == str2[l2 - j - 1]:
+        j += 1
+    return [i, str1[i : l1 - j], str2[i : l2 - j]]
+
+
+def compose_edits(first, second, value):
+    # first = [pos, old, new]の後にsecondをした編集を1つにまとめる．valueは両方をした後の文字列
+    if first is None:
+        return second
+    p1, o1, n1 = first
+    p2, o2, n2 = second
+    start = min(p1, p2)
+    end = max(p1 + len(n1), p2 + len(o2))  # firstの後の位置
+    new = value[start : end + len(n2) - len(o2)]
+    middle = new[: p2 - start] + o2 + new[p2 - start + len(n2) :]
+    return [start, middle[: p1 - start] + o1 + middle[p1 - start + len(n1) :], new]
+
+
+byte_order_marks = (
+    (codecs.BOM_UTF8, "UTF-8-SIG"),
+    (codecs.BOM_UTF16_LE, "UTF-16"),
+    (codecs.BOM_UTF16_BE, "UTF-16"),
+)
+japanese_letters = re.compile("[\u3041-\u30ff\u4e00-\u9fff]")
+unlikely_letters = re.compile("[\uff61-\uff9f\ufffd]")  # 半角カナと変換できなかった文字
+
+
+def count_newlines(s):
+    # 改行コードごとの数
+    crlf = s.count("\r\n")
+    return {"CR+LF": crlf, "CR": s.count("\r") - crlf, "LF": s.count("\n") - crlf}
+
+
+def is_utf8(b, final):
+    try:
+        codecs.getincrementaldecoder("UTF-8")().decode(b, final)  # 途中で切れた文字は残す
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def detect_codes(head, tail=b"", final=False):
+    # ファイルの先頭headと末尾tailから，文字コードと改行コードを推定する．
+    # finalはheadがファイル全体の場合
+    for bom, char_code in byte_order_marks:
+        if head.startswith(bom):
+            break
+    else:
+        odd, even = head[1::2].count(b"\0"), head[::2].count(b"\0")
+        zeros = max(odd, even)
+        # ASCIIの文字は片方のバイトが0になる．紛れ込んだ少しの0では決めず，片方の
+        # バイトの1/8以上が0か，UTF-8として読めない時だけUTF-16とみなす
+        if (
+            zeros > 4 * min(odd, even)
+            and zeros >= 2
+            and (zeros >= len(head) // 16 or not is_utf8(head, final))
+        ):
+            char_code = "UTF-16-LE" if odd > even else "UTF-16-BE"
         else:
-            p = next((i for i in parentheses if s.startswith(i[0])), None)
-            if p is not None:
-                if len(stack) == 0:
-                    pair = p[1]
-                    break
-                elif stack[-1] == p[0]:
-                    del stack[-1]
-        l0 -= 1
-    if pair is None:
-        return None
-    stack = []
-    l1 = selection[1]
-    while l1 < len(string):
-        s = string[l1 : l1 + w]  # はみ出した範囲のぶんは空文字になる．
-        p1 = next((i[1] for i in parentheses if s.startswith(i[0])), None)
-        if p1 is not None:
-            stack.append(p1)
+            t = bytearray(tail[:3])
+            i = 0
+            while i < len(t) and 0x80 <= t[i] < 0xC0:  # 途中から始まる文字は除く
+                i += 1
+            if is_utf8(head, final) and is_utf8(tail[i:], True):
+                char_code = "UTF-8"
+            else:  # 日本語の文字がより多く現れる方
+                scores = []
+                for c in ("CP932", "EUC-JP"):
+                    v = head.decode(c, "replace") + tail.decode(c, "replace")
+                    scores.append(
+                        len(japanese_letters.findall(v))
+                        - len(unlikely_letters.findall(v))
+                    )
+                char_code = "CP932" if scores[0] >= scores[1] else "EUC-JP"
+    h = codecs.getincrementaldecoder(char_code)("replace").decode(head, final)
+    if not final and h.endswith("\r"):  # \r\nの途中かもしれない
+        h = h[:-1]
+    n = count_newlines(h)
+    if tail:
+        if char_code == "UTF-16":  # 末尾にはBOMがない
+            c = "UTF-16-LE" if head.startswith(codecs.BOM_UTF16_LE) else "UTF-16-BE"
         else:
-            p = next((i for i in parentheses if s.startswith(i[1])), None)
-            if p is not None:
-                if len(stack) == 0:
-                    if pair == p[1]:
-                        return [l0, l1 + len(pair)]
-                    else:
-                        return None
-                elif stack[-1] == p[1]:
-                    del stack[-1]
-        l1 += 1
-    return None
+            c = char_code.replace("-SIG", "")
+        t = tail.decode(c, "replace")[1:]
+        for k, v in count_newlines(t).items():
+            n[k] += v
+    if n["CR+LF"] == n["CR"] == n["LF"] == 0:
+        return char_code, "LF"
+    return char_code, max(("LF", "CR+LF", "CR"), key=lambda k: n[k])
+
+
+def save_text(path, chunks, char_code, return_code):
+    # chunksを少しずつ変換して一時ファイルに書き，最後に置き換える．
+    # 途中で落ちても元のファイルは壊れない
+    path = os.path.realpath(path)  # シンボリックリンクの先を置き換える
+    newline = {"LF": "\n", "CR+LF": "\r\n", "CR": "\r"}[return_code]
+    encoder = codecs.getincrementalencoder(char_code)()
+    fd, temp = tempfile.mkstemp(
+        ".tmp", "." + os.path.basename(path) + ".", os.path.dirname(path)
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for c in chunks:
+                if newline != "\n":
+                    c = c.replace("\n", newline)
+                f.write(encoder.encode(c))
+            f.write(encoder.encode("", True))
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):  # 元のファイルの属性を引き継ぐ
+            os.chmod(temp, os.stat(path).st_mode & 0o7777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp, 0o666 & ~umask)
+        try:
+            os.replace(temp, path)
+        except AttributeError:  # python 2
+            if sys.platform == "win32" and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def read_text(path, large=1 << 20):
+    # ファイル全体を(文字列, 文字コード, 改行コード, 改行コードが混在するか)にする．
+    # 改行は書類として開いた時と同じように\nにそろえる．大きなファイルはmmapして，
+    # 読み込んだバイト列の複製を作らずに変換する
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < large:
+            b = f.read()
+        else:
+            b = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            head = b[:65536]
+            tail = b[(size - 65536) & ~1 :] if size > 2 * 65536 else b""
+            char_code, return_code = detect_codes(head, tail, size <= 65536)
+            if not char_code.startswith("UTF-16") and b"\0" in head:
+                raise ValueError(_("バイナリファイルです"))
+            try:
+                v = codecs.decode(b, char_code)
+            except UnicodeDecodeError:  # 先頭と末尾はUTF-8に見えたが，途中が違った
+                if not char_code.startswith("UTF-8"):
+                    raise
+                char_code = "CP932"
+                v = codecs.decode(b, char_code)
+        finally:
+            if type(b) is mmap.mmap:
+                b.close()
+    mixed = len([n for n in count_newlines(v).values() if n > 0]) > 1
+    if return_code == "CR+LF":
+        v = v.replace("\r\n", "\n").replace("\r", "\n")
+    elif return_code == "CR":
+        v = v.replace("\r", "\n")
+    return v, char_code, return_code, mixed
+
+
+def match_globs(path, patterns):
+    # pathはtopからの相対パス．名前か相対パスがどれかに当てはまればTrue
+    path = path.replace(os.sep, "/")
+    name = path.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(path, p) for p in patterns)
+
+
+def walk_files(top, include, exclude):
+    # topより下で，includeのどれかに当てはまり，excludeのどれにも当てはまらないファイル．
+    # excludeに当てはまるディレクトリの中には入らない
+    for root, dirs, files in os.walk(top):
+        rel = os.path.relpath(root, top)
+        rel = "" if rel == os.curdir else rel + os.sep
+        dirs[:] = sorted(d for d in dirs if not match_globs(rel + d, exclude))
+        for f in sorted(files):
+            if (
+                match_globs(rel + f, include)
+                and not match_globs(rel + f, exclude)
+                and os.path.isfile(os.path.join(root, f))
+            ):
+                yield os.path.join(root, f)
+
+
+def shift_span(span, pos, removed, inserted):
+    # posからremoved文字がinserted文字に置き換わった時に，span = [start, end]を追従させる
+    end = pos + removed
+    if end <= span[0]:  # spanより前で変更された
+        span[0] += inserted - removed
+        span[1] += inserted - removed
+    elif pos < span[1]:  # spanと重なる部分が変更された
+        if pos < span[0]:
+            span[0] = pos + inserted
+        span[1] = max(span[1], end) + inserted - removed
+    return span
+
+
+maxima_identifier = r"[A-Za-z_%][\w%]*"
+# 前のブロックの結果や，セッション全体に影響するコマンド
+maxima_global_command = re.compile(
+    r"%[iot]\d+|%th\b|(?<![\w%])%(?![\w%])|\b__?\b|^\s*:lisp |^\s*\?|"
+    r"\b(kill|reset|remove|remvalue|remfunction|load|batch|batchload|demo|"
+    r"tellsimp|tellsimpafter|defrule|defmatch|let|matchdeclare|infix|prefix|"
+    r"postfix|nary|matchfix|nofix|alias|set_random_state|random|newcontext|"
+    r"supcontext|activate|deactivate|killcontext)\s*\(",
+    re.MULTILINE,
+)
 
 
-def str_levels(
-    string, parentheses=None, literals=None, literal_escape="", line_comments=None
-):
-    # example of parentheses: (('(', ')'), ('{', '}'), ('[', ']'))
-    # example of literals: (('"', '"'), ("'", "'"))
-    # example of line_comments: ('#',  "//")
-    # example of literal_escape: '\\'
-    if parentheses is None:
-        parentheses = tuple()
-    elif not isinstance(parentheses[0], (tuple, list)):
-        parentheses = (parentheses,)
-    if literals is None:
-        literals = tuple()
-    elif not isinstance(literals[0], (tuple, list)):
-        literals = (literals,)
-    if line_comments is None:
-        line_comments = tuple()
-    elif not isinstance(line_comments, (tuple, list)):
-        line_comments = (line_comments,)
-    w = max(
-        max([max(len(i[0]), len(i[1])) for i in parentheses + literals]),
-        max([len(i) for i in line_comments]),
-        len(literal_escape),
+def maxima_arguments(commands, i):
+    # commands[i]の"("に対応する")"までの中身を返す
+    level = 0
+    for j in range(i, len(commands)):
+        if commands[j] in "([{":
+            level += 1
+        elif commands[j] in ")]}":
+            level -= 1
+            if level == 0:
+                return commands[i + 1 : j]
+    return commands[i + 1 :]
+
+
+def maxima_symbols(commands):
+    # commandsで定義される記号，使われる記号，定数を代入された記号，
+    # セッション全体に影響するかを返す
+    commands = re.sub(r"/\*(\*(?!/)|[^*])*\*/", "", commands)  # remove comment
+    commands = re.sub(r'"(\\.|[^"\\])*"', '""', commands)  # remove string
+    used = set(re.findall(maxima_identifier, commands))
+    defined = set()
+    # a: 1, f(x) := x, a[i] :: 1
+    for m in re.finditer(
+        r"(" + maxima_identifier + r")\s*(\([^()]*\)|\[[^\[\]]*\])?\s*(::?=?)",
+        commands,
+    ):
+        defined.add(m.group(1))
+    for m in re.finditer(
+        r"\b(define|depends|assume|forget|declare|gradef|atvalue|put)\s*\(", commands
+    ):
+        a = maxima_arguments(commands, m.end() - 1)
+        if m.group(1) in ("assume", "forget"):  # 引数全体が事実
+            defined.update(re.findall(maxima_identifier, a))
+        else:  # 最初の引数
+            first = re.match(r"\s*(\[[^\]]*\]|[^,]*)", a).group(1)
+            names = re.findall(maxima_identifier, first)
+            if m.group(1) in ("define", "gradef", "atvalue"):  # f(x)のfだけ
+                names = names[:1]
+            defined.update(names)
+    # fpprec: 30, ratprint: false
+    settings = set(
+        re.findall(
+            r"(?:^|[;$,(])\s*(" + maxima_identifier + r")\s*:\s*[\w.%+-]+\s*(?=[;$,)]|$)",
+            commands,
+        )
+    )
+    return (
+        defined,
+        used,
+        settings,
+        maxima_global_command.search(commands) is not None,
     )
 
-    def str_levels_local(parentheses, literals, line_comments, index, level):
-        start = index
-        levels = []
-        while index < len(string):
-            s = string[index : index + w]  # はみ出した範囲のぶんは空文字になる
-            old_index = index
-            for i in line_comments:
-                if s.startswith(i):
-                    if start != index:
-                        levels.append([start, index, level])
-                    while index < len(string):
-                        index += 1
-                        s = string[
-                            index : index + w
-                        ]  # はみ出した範囲のぶんは空文字になる
-                        if s.startswith("\n") or s.startswith("\r"):
-                            index += 1
-                            break
-                    levels.append([old_index, index, level + 1])
-                    start = index  # levelsに追加したのでstartを更新
-            for i in literals:
-                if i[0] is not None and s.startswith(i[0]):
-                    if start != index:
-                        levels.append([start, index, level])
-                    index += len(i[0])
-                    if index == len(string):
-                        levels.append([old_index, index, level + 1])
-                    else:
-                        l, index = str_levels_local(
-                            (), ((None, i[1]),), (), index, level + 1
-                        )
-                        l[0][0] = old_index  # 先頭のstartを修正
-                        levels.extend(l)
-                    start = index  # levelsに追加したのでstartを更新
-                elif s.startswith(literal_escape):
-                    index += len(literal_escape) + 1
-                elif s.startswith(i[1]):
-                    index += len(i[1])
-                    if (
-                        level > 0
-                    ):  # レベル0なら始まりが見つからずに，いきなり終わりが見つかったことになる
-                        levels.append([start, index, level])
-                        return levels, index
-            for i in parentheses:
-                if i[0] is not None and s.startswith(i[0]):
-                    if start != index:
-                        levels.append([start, index, level])
-                    index += len(i[0])
-                    if index == len(string):
-                        levels.append([old_index, index, level + 1])
-                    else:
-                        l, index = str_levels_local(
-                            parentheses, literals, line_comments, index, level + 1
-                        )
-                        l[0][0] = old_index  # 先頭のstartを修正
-                        levels.extend(l)
-                    start = index  # levelsに追加したのでstartを更新
-                elif s.startswith(i[1]):
-                    index += len(i[1])
-                    if (
-                        level > 0
-                    ):  # レベル0なら始まりが見つからずに，いきなり終わりが見つかったことになる
-                        levels.append([start, index, level])
-                        return levels, index
-            if old_index == index:
-                index += 1
-        if start != index:
-            levels.append([start, index, level])
-        return levels, index
 
-    return str_levels_local(parentheses, literals, line_comments, index=0, level=0)[0]
+def strip_label_numbers(last_input, outputs):
+    # /* (%i3): */を/* (%i): */に，/* (%o3): */を/* (%o): */にする
+    label = re.compile(r"^/\* \(%([io])\d+\): \*/$", re.MULTILINE)
+    return (
+        label.sub(r"/* (%\1): */", last_input),
+        [label.sub(r"/* (%\1): */", o) for o in outputs],
+    )
+
+
+def independent_blocks(blocks):
+    # 互いに記号を共有しないブロックの組に分け，インデックスのリストのリストを返す
+    parent = list(range(len(blocks)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        parent[root(i)] = root(j)
+
+    symbols = [maxima_symbols(b) for b in blocks]
+    users = {}  # {symbol: [index, ...]}
+    for i, (defined, used, settings, is_global) in enumerate(symbols):
+        for n in used | defined:
+            users.setdefault(n, []).append(i)
+    for i, (defined, used, settings, is_global) in enumerate(symbols):
+        if is_global:
+            for j in range(len(blocks)):
+                union(i, j)
+            continue
+        for n in settings:
+            if len(users[n]) == 1:
+                # 他のブロックで使われない記号への定数の代入は，fpprecなどのオプション変数かもしれない
+                for j in range(i + 1, len(blocks)):
+                    union(i, j)
+        for n in defined:
+            for j in users[n]:
+                union(i, j)
+    components = {}
+    for i in range(len(blocks)):
+        components.setdefault(root(i), []).append(i)
+    return sorted(components.values())
+
+
+def block_dependencies(blocks):
+    # ブロックごとに[ハッシュ, 定義する記号, 使う記号, {記号: それを定義した前のブロック},
+    # セッション全体に影響するか]を返す．ハッシュは依存する前のブロックのハッシュも含む
+    dependencies = []
+    definers = {}  # {symbol: index}
+    last_global = None
+    for i, b in enumerate(blocks):
+        defined, used, settings, is_global = maxima_symbols(b)
+        upstream = dict((n, definers[n]) for n in used if n in definers)
+        h = hashlib.sha1(b.encode("UTF-8"))
+        js = set(upstream.values())
+        if last_global is not None:
+            js.add(last_global)
+        for j in sorted(js):
+            h.update(dependencies[j][0].encode("UTF-8"))
+        dependencies.append([h.hexdigest(), defined, used, upstream, is_global])
+        for n in defined:
+            definers[n] = i
+        if is_global or len(settings) > 0:  # オプション変数は後のすべてのブロックに影響する
+            last_global = i
+    return dependencies
+
+
+def schedule_blocks(stale, dependencies, definers):
+    # staleのブロックを評価し直す順番を[[index, kill commands], ...]で返す．
+    # 使う記号をMaximaで最後に定義したブロック（definers = {記号: ハッシュ}）が文書と
+    # 違えば，そのブロックを先に評価し直すか，定義を消してから評価する．
+    # 依存の鎖が長くても再帰しないように，スタックを使って深さ優先で並べる
+    state = dict(definers)
+    order = []
+    scheduled = set()  # orderに入れたか，入れる途中のブロック
+    for k in stale:
+        if k in scheduled:
+            continue
+        scheduled.add(k)
+        stack = [(k, iter(sorted(dependencies[k][2])), [])]
+        while len(stack) > 0:
+            i, names, kills = stack[-1]
+            for n in names:
+                j = dependencies[i][3].get(n)
+                if state.get(n) == (None if j is None else dependencies[j][0]):
+                    continue
+                if j is None:
+                    kills.append("kill({})$".format(n))
+                    del state[n]
+                elif j not in scheduled:  # 先に並べてから，続きの記号を調べる
+                    scheduled.add(j)
+                    stack.append((j, iter(sorted(dependencies[j][2])), []))
+                    break
+            else:
+                stack.pop()
+                order.append([i, "".join(kills)])
+                for n in dependencies[i][1]:
+                    state[n] = dependencies[i][0]
+    return order
+
+
+def str_levels(
+    string, parentheses=None, literals=None, literal_escape="", line_comments=None
+):
+    # [開始, 終了, 深さ]のリスト．深く入れ子になっていても再帰しない
+    return LevelLexer(parentheses, literals, literal_escape, line_comments).lex(
+        string
+    )[0]
 
 
 def line_numbered_str(string, head=True, prefix="", suffix=": "):
@@ -401,47 +647,714 @@ def openfoam_bc_template_string(bc, indent="", include_src_url=False):
     return s
 
 
-class Maxima(object):
-    def __init__(self):
-        self.init()
+# Maximaの演算子の結合力．binary: (左, 右), prefix: 右, postfix: 左
+maxima_binary_operators = {
+    ":": (180, 20),
+    "::": (180, 20),
+    ":=": (180, 20),
+    "::=": (180, 20),
+    "=": (80, 80),
+    "#": (80, 80),
+    "<": (80, 80),
+    "<=": (80, 80),
+    ">": (80, 80),
+    ">=": (80, 80),
+    "+": (100, 100),
+    "-": (100, 100),
+    "*": (120, 120),
+    "/": (120, 120),
+    ".": (130, 129),  # a.b.c = a.(b.c)
+    "^": (140, 139),  # a^b^c = a^(b^c)
+    "^^": (140, 139),
+    "**": (140, 139),
+}
+maxima_assignment_operators = (":", "::", ":=", "::=")  # 右側を全て取り込む
+maxima_prefix_operators = {"-": 134, "+": 134, "'": 200}  # -a^b = -(a^b)
+maxima_postfix_operators = {"!": 160, "!!": 160}
+maxima_brackets = {"(": ")", "call": ")", "[": "]", "subscript": "]", "{": "}"}
+maxima_collections = {"[": "list", "{": "set"}
+maxima_expression_token = re.compile(
+    r'(?P<string>"(?:[^"\\]|\\.)*")'
+    r"|(?P<number>(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eEbB][-+]?[0-9]+)?)"
+    r"|(?P<name>\??[%A-Za-z_][%\w]*)"
+    r"|(?P<operator>::=|:=|::|<=|>=|\*\*|\^\^|!!|[:=#<>+\-*/^.!'])"
+    r"|(?P<open>[(\[{])"
+    r"|(?P<close>[)\]}])"
+    r"|(?P<comma>,)"
+)
 
-    def init(self):
-        if sys.platform == "win32":
-            import pexpect.popen_spawn as psp  # pip install pexpect
 
-            self.maxima = psp.PopenSpawn(maxima_location + " -q")
+def parse_maxima_expression(s):
+    # 空白を含まない1次元の出力を構文木にする．解析できない時はNoneを返す
+    # ("atom", text), ("binary", op, left, right), ("prefix", op, operand),
+    # ("postfix", op, operand), ("call", function, args), ("subscript", array, args),
+    # ("list", items), ("set", items), ("group", items)
+    # 再帰せず，被演算子と演算子のスタックで解析する
+    operands = []
+    operators = []  # [kind, op or function or array, number of args]
+    expect_operand = True
+
+    def reduce():
+        kind, op, n = operators.pop()
+        if kind == "binary":
+            right = operands.pop()
+            operands.append((kind, op, operands.pop(), right))
+        else:  # prefix
+            operands.append((kind, op, operands.pop()))
+
+    def reduce_while(bp):
+        # 右の結合力がbp以上の演算子を適用する
+        while len(operators) > 0 and operators[-1][0] in ("binary", "prefix"):
+            op = operators[-1][1]
+            if operators[-1][0] == "binary":
+                r = maxima_binary_operators[op][1]
+            else:
+                r = maxima_prefix_operators[op]
+            if r < bp:
+                break
+            reduce()
+
+    pos = 0
+    kind = None
+    while pos < len(s):
+        m = maxima_expression_token.match(s, pos)
+        if m is None:
+            return None
+        pos = m.end()
+        last = kind
+        kind, t = m.lastgroup, m.group()
+        if expect_operand:
+            if kind in ("string", "number", "name"):
+                operands.append(("atom", t))
+                expect_operand = False
+            elif kind == "operator" and t in maxima_prefix_operators:
+                operators.append(["prefix", t, 0])
+            elif kind == "open":
+                operators.append([t, None, 0])
+            elif (
+                kind == "close"
+                and last == "open"
+                and maxima_brackets[operators[-1][0]] == t
+                and operators[-1][0] != "("
+            ):  # f(), [], {}, a[]
+                marker, base, n = operators.pop()
+                if marker in ("[", "{"):
+                    operands.append((maxima_collections[marker], []))
+                else:
+                    operands.append((marker, base, []))
+                expect_operand = False
+            else:
+                return None
+        elif kind == "operator" and t in maxima_binary_operators:
+            reduce_while(maxima_binary_operators[t][0])
+            operators.append(["binary", t, 0])
+            expect_operand = True
+        elif kind == "operator" and t in maxima_postfix_operators:
+            reduce_while(maxima_postfix_operators[t])
+            operands.append(("postfix", t, operands.pop()))
+        elif kind == "open" and t != "{":  # f(x), a[i]
+            marker = "call" if t == "(" else "subscript"
+            operators.append([marker, operands.pop(), 0])
+            expect_operand = True
+        elif kind in ("comma", "close"):
+            reduce_while(0)
+            if len(operators) == 0:
+                return None
+            operators[-1][2] += 1
+            if kind == "comma":
+                expect_operand = True
+                continue
+            marker, base, n = operators.pop()
+            if maxima_brackets.get(marker) != t:
+                return None
+            items = operands[-n:]
+            del operands[-n:]
+            if marker == "(":
+                operands.append(items[0] if n == 1 else ("group", items))
+            elif marker in ("[", "{"):
+                operands.append((maxima_collections[marker], items))
+            else:
+                operands.append((marker, base, items))
+        else:
+            return None
+    if expect_operand:
+        return None
+    reduce_while(0)
+    if len(operators) > 0 or len(operands) != 1:
+        return None
+    return operands[0]
+
+
+def print_maxima_expression(node):
+    # 構文木を，必要な括弧だけを付けた文字列にする
+    out = []
+    stack = [node]
+
+    def push(child, parentheses):
+        if parentheses:
+            stack.extend((")", child, "("))
         else:
-            import pexpect  # pip install pexpect
+            stack.append(child)
+
+    def push_items(items, start, end):
+        stack.append(end)
+        for i, item in enumerate(reversed(items)):
+            if i > 0:
+                stack.append(",")
+            stack.append(item)
+        stack.append(start)
+
+    while len(stack) > 0:
+        node = stack.pop()
+        if not isinstance(node, tuple):
+            out.append(node)
+            continue
+        kind = node[0]
+        if kind == "atom":
+            out.append(node[1])
+        elif kind == "binary":
+            op, left, right = node[1:]
+            while op in ("+", "-") and right[0] == "prefix" and right[1] == "-":
+                # a + (-b) = a - b, a - (-b) = a + b
+                op, right = "-" if op == "+" else "+", right[2]
+            l, r = maxima_binary_operators[op]
+            if right[0] == "binary":
+                # a + (b - c) = a + b - c, a*(b/c) = a*b/c
+                p = (
+                    maxima_binary_operators[right[1]][0] <= r
+                    and not (
+                        op == "+"
+                        and right[1] in ("+", "-")
+                        or op == "*"
+                        and right[1] in ("*", "/")
+                    )
+                    or right[1] in maxima_assignment_operators
+                    and op not in maxima_assignment_operators
+                )  # a*(b:c)
+            elif right[0] == "prefix":  # a*(-b), %e^-x
+                p = right[1] != "'" and op not in (
+                    "^",
+                    "^^",
+                    "**",
+                    "=",
+                    "#",
+                    "<",
+                    "<=",
+                    ">",
+                    ">=",
+                    ":",
+                    "::",
+                    ":=",
+                    "::=",
+                )
+            else:
+                p = False
+            push(right, p)
+            stack.append(op)
+            if left[0] == "binary":
+                p = l > maxima_binary_operators[left[1]][1]  # (a^b)^c
+            elif left[0] == "prefix":
+                p = l > maxima_prefix_operators[left[1]]  # (-a)^b
+            else:
+                p = False
+            push(left, p)
+        elif kind == "prefix":
+            op, operand = node[1:]
+            r = maxima_prefix_operators[op]
+            if operand[0] == "binary":
+                p = (
+                    maxima_binary_operators[operand[1]][0] <= r
+                    or operand[1] in maxima_assignment_operators
+                )  # -(a + b), -(a:b)
+            elif operand[0] == "prefix":
+                p = True  # -(-a)
+            elif operand[0] == "postfix":
+                p = maxima_postfix_operators[operand[1]] <= r
+            else:
+                p = False
+            push(operand, p)
+            stack.append(op)
+        elif kind == "postfix":
+            op, operand = node[1:]
+            stack.append(op)
+            push(operand, operand[0] in ("binary", "prefix", "postfix"))  # (n!)!
+        elif kind == "call":
+            push_items(node[2], "(", ")")
+            push(node[1], node[1][0] in ("binary", "prefix", "postfix"))
+        elif kind == "subscript":
+            push_items(node[2], "[", "]")
+            push(node[1], node[1][0] in ("binary", "prefix", "postfix"))
+        elif kind == "list":
+            push_items(node[1], "[", "]")
+        elif kind == "set":
+            push_items(node[1], "{", "}")
+        else:  # group
+            push_items(node[1], "(", ")")
+    return "".join(out)
+
+
+def minimize_parentheses(s):
+    # 空白を含まない1次元の出力から冗長な括弧を取り除く．解析できなければそのまま返す
+    node = parse_maxima_expression(s)
+    return s if node is None else print_maxima_expression(node)
+
+
+def spawn_maxima():
+    # 起動して初期設定まで済ませたMaximaを返す
+    if sys.platform == "win32":
+        import pexpect.popen_spawn as psp  # pip install pexpect
+
+        maxima = psp.PopenSpawn(maxima_location + " -q")
+    else:
+        import pexpect  # pip install pexpect
+
+        maxima = pexpect.spawn(maxima_location, ["-q"])
+    maxima.expect(".+")
+    for c in ("display2d: false$", "kill(labels)$"):
+        maxima.sendline(c)
+        while True:
+            maxima.expect(".+")
+            after = maxima.after
+            if sys.version_info.major > 2:
+                after = after.decode("UTF-8")
+            if re.search(r"\(%i\d\)", after):
+                break
+    return maxima
+
+
+def close_maxima(maxima):
+    try:
+        maxima.sendline("quit();")
+    except:
+        pass
+    try:
+        if sys.platform == "win32":
+            maxima.kill(0)
+        else:
+            maxima.close()
+    except:
+        pass
 
-            self.maxima = pexpect.spawn(maxima_location, ["-q"])
-        self.maxima.expect(".+")
+
+class MaximaPool(object):
+    # 初期設定済みのMaximaをバックグラウンドで起動して待機させておく
+    def __init__(self, size=1):
+        self.size = size
+        self.standby = queue.Queue()
+        self.lock = threading.Lock()
+        self.filling = False
+        self.closed = False
+
+    def get(self):
+        # 待機中のものがなければ，その場で起動する
+        try:
+            maxima = self.standby.get_nowait()
+        except queue.Empty:
+            maxima = spawn_maxima()
+        self.fill()
+        return maxima
+
+    def fill(self):
+        with self.lock:
+            if self.filling or self.closed:
+                return
+            self.filling = True
+        t = threading.Thread(target=self.work)
+        t.daemon = True
+        t.start()
+
+    def work(self):
+        try:
+            while not self.closed and self.standby.qsize() < self.size:
+                self.standby.put(spawn_maxima())
+        except:
+#            print(sys.exc_info())
+            pass
+        with self.lock:
+            self.filling = False
+        if self.closed:
+            self.close()
+
+    def discard(self, maxima):
+        # 終了を待つと止まるので，バックグラウンドで終了させる
+        t = threading.Thread(target=close_maxima, args=(maxima,))
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                close_maxima(self.standby.get_nowait())
+            except queue.Empty:
+                break
+
+
+class Maxima(object):
+    # 文字列, 空白（と改行）
+    output_spaces = {
+        False: re.compile(r'("(?:\\.|[^"])*")| +'),
+        True: re.compile(r'("(?:\\.|[^"])*")|[ \n]+'),
+    }
+    # 文字列, 'func(
+    output_quote = re.compile(r'("(?:\\.|[^"])*")|\'(?=[_A-Za-z][_A-Za-z0-9]*\()')
+    # 文字列, a-b, + = ,
+    output_operator = re.compile(r'("(?:\\.|[^"])*")|([^(^\[=,])-|[+=,]')
+    # 文字列, 1.0e + 10
+    output_exponent = re.compile(
+        r'("(?:\\.|[^"])*")|([^_A-Za-z](?:[0-9]+\.?|\.[0-9]+)[eb]) ([-+]) ([0-9])'
+    )
+    stream_interval = 0.2  # 評価中の出力を表示する間隔（秒）
+    interrupt_grace = 5.0  # 割り込んでもこれだけ待って終わらなければ再起動する（秒）
+    pipeline_window = 32  # まとめて送るコマンドの最大数
+    pipeline_chars = 2048  # まとめて送るコマンドの最大文字数
+    pipeline_sentinel = "texteditwx_sentinel_"
+    cache_size = 1000  # 覚えておく計算結果の数
+    # 実行するとセッションの状態が変わる関数
+    stateful_functions = (
+        r"\b(kill|reset|remove|forget|assume|declare|load|batch|batchload|define|"
+        r"defrule|defmatch|tellsimp|tellsimpafter|matchdeclare|gradef|depends|atvalue|"
+        r"put|array|alias|infix|prefix|postfix|nary|matchfix|nofix|texput|random|"
+        r"set_random_state|translate|compile|writefile|closefile|save|stringout|"
+        r"setup_autoload|with_stdout|read|readonly|demo|plot2d|plot3d|draw|draw2d|"
+        r"draw3d|elapsed_real_time|elapsed_run_time|absolute_real_time|timedate)\s*\("
+    )
+    asking_functions = (
+        r"\b(integrate|defint|risch|specint|limit|tlimit|sum|nusum|product|taylor|"
+        r"powerseries|solve|ode2|ic1|ic2|bc2|desolve|laplace|ilt|asksign|load|batch|"
+        r"batchload|demo|read|readonly|plot2d|plot3d|draw|draw2d|draw3d)\s*\("
+    )
+
+    def __init__(self, pool=None, cache=None, cache_lock=None):
+        # 並列に評価する時は，poolとcacheを他のMaximaと共有する
+        self.pipeline = True
+        self.stream = None
+        self.own_pool = pool is None
+        self.pool = MaximaPool() if pool is None else pool
+        # {(fingerprint, command): output}
+        self.cache = collections.OrderedDict() if cache is None else cache
+        # cacheは他のMaximaのworkerスレッドからも使われる
+        self.cache_lock = threading.Lock() if cache_lock is None else cache_lock
+        self.jobs = queue.Queue()
+        self.n_jobs = 0  # メインスレッドからのみ変更する
+        self.running = False
+        self.interrupted = False
+        self.job_count = 0  # workerスレッドで始めたジョブの数
+        self.maxima = None  # 起動はworkerスレッドで行い，エディタの表示を待たせない
+        self.status = _("起動待ち")
+        self.on_status = None  # 状態が変わるとメインスレッドで呼ばれる
+        # Maximaとのやりとりはworkerスレッドで行い，GUIを止めない
+        self.worker = threading.Thread(target=self.work)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def init(self):
+        self.maxima = self.pool.get()
         self.in_help = False
         self.commands_list = []
-        for c in ("display2d: false$", "kill(labels)$"):
-            self.maxima.sendline(c)
-            while True:
-                self.maxima.expect(".+")
-                if sys.version_info.major > 2:
-                    self.maxima.after = self.maxima.after.decode("UTF-8")
-                if re.search(r"\(%i\d\)", self.maxima.after):
-                    break
         self.last_input = "/* (%i1): */"
+        self.fingerprint = ""  # これまでに実行した，状態を変えるコマンドのハッシュ
 
     def reset(self):
-        for c in ("reset()$", "display2d: false$"):
-            self.maxima.sendline(c)
-            while True:
-                self.maxima.expect(".+")
-                if sys.version_info.major > 2:
-                    self.maxima.after = self.maxima.after.decode("UTF-8")
-                if re.search(r"\(%i\d\)", self.maxima.after):
-                    break
+        # 待機していたMaximaと入れ替える
+        maxima = self.maxima
+        self.init()
+        self.pool.discard(maxima)
+
+    def set_status(self, status):
+        self.status = status
+        if self.on_status is not None:
+            wx.CallAfter(self.on_status, status)
+
+    def start(self):
+        self.set_status(_("起動中"))
+        try:
+            self.init()
+        except:
+#            print(sys.exc_info())
+            self.maxima = None
+            self.set_status(_("起動失敗"))
+            return False
+        self.set_status(_("準備完了"))
+        return True
+
+    def submit(self, callback, function, *args):
+        # functionをworkerスレッドで実行し，その戻り値をメインスレッドでcallbackに渡す
+        self.n_jobs += 1
+        self.jobs.put((callback, function, args))
+
+    def work(self):
+        self.start()
+        while True:
+            job = self.jobs.get()
+            if job is None:  # quit
+                close_maxima(self.maxima)
+                return
+            callback, function, args = job
+            # 起動に失敗していたら，もう一度起動してみる
+            if self.maxima is None and not self.start():
+                wx.CallAfter(self.finish_job, callback, None)
+                continue
+            self.job_count += 1
+            self.running = True
+            self.interrupted = False
+            self.set_status(_("評価中"))
+            try:
+                r = function(*args)
+            except:
+#                print(sys.exc_info())
+                r = None
+            self.running = False
+            if self.jobs.empty():
+                self.set_status(_("準備完了"))
+            wx.CallAfter(self.finish_job, callback, r)
+
+    def finish_job(self, callback, r):
+        self.n_jobs -= 1
+        if callback is not None:
+            callback(r)
+
+    def evaluate(self, commands, replace=False, timeout=None, stream=None):
+        # workerスレッド用．評価の前の入力ラベルも一緒に返す
+        # streamを与えると，forやprintの出力を評価中にメインスレッドで行のリストとして渡す
+        last_input = self.last_input
+        self.stream = stream
+        try:
+            outputs, l_output = self.send_commands(commands, replace, timeout)
+        finally:
+            self.stream = None
+        return last_input, outputs, l_output
+
+    def quit(self):
+        # 待っているコマンドを評価し終えたら終了する
+        self.jobs.put(None)
+
+    def save_state(self, path):
+        # 別のMaximaに読み込ませるため，値と関数の定義を保存する
+        return self.send_commands(
+            'save("{}", values, functions, macros, arrays, myoptions)$'.format(
+                path.replace("\\", "/")
+            )
+        )
+
+    def restore_state(self, path, commands):
+        # save_stateで保存したものを読み込み，assumeなどの事実はcommandsを評価し直す
+        return self.send_commands(
+            'load("{}")$'.format(path.replace("\\", "/")) + commands
+        )
+
+    def interrupt(self):
+        # 待っているコマンドは取り消し，評価中のコマンドには割り込みを送る
+        stop = False
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                stop = True
+                continue
+            callback, function, args = job
+            wx.CallAfter(self.finish_job, callback, None)
+        if stop:
+            self.quit()
+        if not self.running or self.maxima is None:
+            return
+        self.interrupted = True
+        del self.commands_list[:]
+        if sys.platform == "win32":
+            # PopenSpawnにはCtrl+Cを送れない（同じコンソールの自分にも届く）ので再起動する
+            self.maxima.kill(0)
+        else:
+            self.maxima.sendintr()
+            # 割り込みを受け付けない計算は，しばらく待っても終わらなければ終了させる
+            timer = threading.Timer(
+                self.interrupt_grace,
+                self.force_stop,
+                (self.maxima, self.job_count),
+            )
+            timer.daemon = True
+            timer.start()
+
+    def force_stop(self, maxima, job_count):
+        # 終了させると評価中のexpectが失敗し，待機していたMaximaと入れ替わる
+        if self.running and self.maxima is maxima and self.job_count == job_count:
+            try:
+                maxima.terminate(force=True)
+            except:
+#                print(sys.exc_info())
+                pass
+
+    def is_pure(self, c):
+        # 結果が，それまでに状態を変えたコマンドだけで決まるコマンドか
+        return (
+            c.endswith(";")
+            and not self.in_help
+            and not c.startswith("?")
+            and not c.startswith("example(")
+            and not re.match(r"(for|thru|while|unless) |(s?print|printf|display) *\(", c)
+            and ":" not in c  # 代入，関数定義，blockの局所変数
+            and not re.search(self.stateful_functions, c)
+            # 以前の入出力ラベル（%, %o1, %th(2), _など）．%i, %piなどは定数
+            and not re.search(r"%[iot]\d+|%th\b|(?<![\w%])%(?![\w%])|\b__?\b", c)
+            # 文字列は引用符なしで出力されるので，そのまま入力し直せない
+            and '"' not in c
+            and not re.search(
+                r"\b(string|concat|sconcat|simplode|printf|tex1?|ssubst|supcase|sdowncase)\s*\(",
+                c,
+            )
+        )
+
+    def cached_command(self, c):
+        # キャッシュにあれば，Maximaで計算し直さず結果を評価せずに出力させる
+        # （%や出力ラベルがそのまま使えるように，Maximaには出力させる）
+        key = (self.fingerprint, c)
+        with self.cache_lock:
+            output = self.cache.pop(key, None)
+            if output is None:
+                return c
+            self.cache[key] = output  # 最近使ったものを末尾に
+        return "'(" + output + ");"
+
+    def update_cache(self, c, sent, output):
+        if sent != c:  # キャッシュから出力した
+            return
+        if self.is_pure(c):
+            # CRE形式（/R/）やテイラー級数（/T/，. . .）の出力は，そのまま入力できない
+            if (
+                output
+                and not output.startswith(("/R/", "/T/"))
+                and ". . ." not in output
+            ):
+                with self.cache_lock:
+                    self.cache[(self.fingerprint, c)] = output
+                    while len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+        else:
+            self.fingerprint = hashlib.sha1(
+                (self.fingerprint + "\n" + c).encode("UTF-8")
+            ).hexdigest()
+
+    def load_cache(self, path):
+        try:
+            with codecs.open(path, "r", encoding="UTF-8") as f:
+                cache = ast.literal_eval(f.read())
+            with self.cache_lock:
+                for fingerprint, c, output in cache:
+                    self.cache[(fingerprint, c)] = output
+        except:
+#            print(sys.exc_info())
+            pass
+
+    def save_cache(self, path):
+        try:
+            with self.cache_lock:
+                items = list(self.cache.items())
+            with codecs.open(path, "w", encoding="UTF-8") as f:
+                f.write("[\n")
+                for k, v in items:
+                    f.write("{},\n".format(repr((k[0], k[1], v))))
+                f.write("]\n")
+        except:
+#            print(sys.exc_info())
+            pass
+
+    def can_pipeline(self, c):
+        # 出力の扱いが特殊なコマンドや，質問が返ってくるかもしれないコマンドは1つずつ送る
+        return not (
+            self.in_help
+            or c.startswith(":lisp ")
+            or c.startswith("?")
+            or c.startswith("example(")
+            or re.match(r"(for|thru|while|unless) |(s?print|printf|display) *\(", c)
+            or re.search(self.asking_functions, c)
+        )
+
+    def send_pipelined(self, timeout=-1):
+        # 先頭から続けて送れるコマンドをまとめて送り，番兵の出力で区切って
+        # [(command, sent command, before, after), ...]を返す．1つしか送れない時は[]を返す
+        window = []
+        n = 0
+        while (
+            len(self.commands_list) > 0
+            and len(window) < self.pipeline_window
+            and n + len(self.commands_list[0]) < self.pipeline_chars
+            and self.can_pipeline(self.commands_list[0])
+        ):
+            # 入力が端末のバッファに収まらないと，出力を読めずに止まってしまう
+            window.append(self.commands_list.pop(0))
+            n += len(window[-1]) + 50
+        if len(window) < 2:
+            self.commands_list[0:0] = window
+            return []
+        lines = []
+        for k, c in enumerate(window):
+            lines.append(self.cached_command(c))
+            # エコーされた番兵のコマンドにはマッチしないように，出力で文字列を連結させる
+            lines.append(
+                ':lisp (format t "~a~d~%" "{}" {})'.format(self.pipeline_sentinel, k)
+            )
+        try:
+            self.maxima.setecho(False)
+            echo = self.maxima.getecho()
+        except:  # PopenSpawnなど
+            echo = True
+        try:
+            self.maxima.sendline("\n".join(lines))
+            echoes = set(j.strip() for i in lines for j in i.split("\n"))
+            echoes.discard("")
+            results = []
+            for k, c in enumerate(window):
+                self.expect(
+                    re.escape(self.pipeline_sentinel) + str(k) + r"\r?\n", timeout
+                )
+                # 1つ前の番兵の:lispが返すNILとプロンプトを取り除く
+                s = self.maxima.before
+                if k > 0:
+                    s = re.sub(r"^\n*(NIL\n)?\n*\(%i\d+\) ?", "", s)
+                if echo:
+                    s = "\n".join(i for i in s.split("\n") if i.strip() not in echoes)
+                m = re.search(r"\(%i\d+\)\s*$", s)
+                if m:
+                    results.append((c, lines[2 * k], s[: m.start()], m.group()))
+                else:  # 質問が返ってきた
+                    results.append((c, lines[2 * k], "", s))
+            self.expect(r"\(%i\d+\)\s*$", timeout)  # 最後の番兵の後のプロンプト
+        finally:
+            if not echo:
+                try:
+                    self.maxima.setecho(True)
+                except:
+                    pass
+        return results
+
+    def expect_streaming(self, pattern, sent, timeout=-1):
+        # patternが現れるまで1行ずつ読み，エコー以外の行をまとめてself.streamに渡す
+        echo = sent + "\n"
+        lines = []
+        buffer = []
+        t = time.time()
+        while self.expect([pattern, r"\r?\n"], timeout) == 1:
+            line = self.maxima.before
+            lines.append(line)
+            if echo.startswith(line + "\n"):
+                echo = echo[len(line) + 1 :]
+                continue
+            echo = ""
+            buffer.append(line)
+            if time.time() - t > self.stream_interval:
+                wx.CallAfter(self.stream, buffer)
+                buffer = []
+                t = time.time()
+        lines.append(self.maxima.before)
+        self.maxima.before = "\n".join(lines)
 
     def expect(self, pattern, timeout=-1):
         # if timeout = -1, default value (30 s) is used.
         # if timeout = None, timeout never occures.
+        # patternがリストの時は，マッチしたもののインデックスを返す
         try:
-            self.maxima.expect(pattern, timeout)
+            i = self.maxima.expect(pattern, timeout)
             if sys.version_info.major > 2:
                 # bytes -> str
                 self.maxima.before = self.maxima.before.decode("UTF-8")
@@ -453,23 +1366,27 @@ class Maxima(object):
                 self.maxima.after
             ):
                 self.maxima.before = self.maxima.before[: -len(self.maxima.after)]
+            return i
         except:
 #            print(sys.exc_info())
-            with wx.MessageDialog(
-                None,
-                _("{}\nMaximaを再起動します．").format(sys.exc_info()[0]),
-                _("例外発生"),
-                style=wx.ICON_ERROR,
-            ) as md:
-                md.ShowModal()
-            if sys.platform == "win32":
-                self.maxima.kill(0)
+            def show_error(e):
+                with wx.MessageDialog(
+                    None,
+                    _("{}\nMaximaを再起動します．").format(e),
+                    _("例外発生"),
+                    style=wx.ICON_ERROR,
+                ) as md:
+                    md.ShowModal()
+
+            if wx.IsMainThread():
+                show_error(sys.exc_info()[0])
             else:
-                self.maxima.close()
+                wx.CallAfter(show_error, sys.exc_info()[0])
+            self.pool.discard(self.maxima)  # interruptで既に終了していることもある
             self.init()
             raise
 
-    def send_commands(self, commands, replace=False):
+    def send_commands(self, commands, replace=False, timeout=-1):
         debug = False
         if debug:
             print("send_commands")
@@ -507,30 +1424,50 @@ class Maxima(object):
         if debug:
             print("    commands_list = {}".format(self.commands_list))
         outputs = []
+        pipelined = []  # [(command, sent command, before, after), ...]
         while len(self.commands_list) > 0:
-            c = self.commands_list.pop(0)
-            self.maxima.sendline(c)
-            if debug:
-                print("    ----------")
-                print('    command = "{}"'.format(c))
-            try:
-                self.expect(
-                    r"(\(%i\d+\)|Enter space-separated numbers, `all' or `none':|.+\?)\s*$"
-                )
-            except:
-                raise
-            if self.maxima.before.startswith(c + "\n"):
-                self.maxima.before = self.maxima.before[len(c) + 1 :]
+            if self.pipeline and len(pipelined) == 0 and not self.interrupted:
+                pipelined = self.send_pipelined(timeout)
+            if len(pipelined) > 0:
+                c, sent, self.maxima.before, self.maxima.after = pipelined.pop(0)
+                if debug:
+                    print("    ----------")
+                    print('    pipelined command = "{}"'.format(c))
+            else:
+                c = self.commands_list.pop(0)
+                sent = self.cached_command(c)
+                self.maxima.sendline(sent)
+                if debug:
+                    print("    ----------")
+                    print('    command = "{}"'.format(c))
+                pattern = r"(\(%i\d+\)|Enter space-separated numbers, `all' or `none':|.+\?)\s*$"
+                if (
+                    self.stream is not None
+                    and not replace
+                    and re.match(
+                        r"(for|thru|while|unless) |(s?print|printf|display) *\(", c
+                    )
+                ):
+                    self.expect_streaming(pattern, sent, timeout)
+                else:
+                    self.expect(pattern, timeout)
+            if self.maxima.before.startswith(sent + "\n"):
+                self.maxima.before = self.maxima.before[len(sent) + 1 :]
             if debug:
                 print('    before = "{}"'.format(self.maxima.before))
                 print('    after = "{}"'.format(self.maxima.after))
             if self.maxima.after.startswith("(%i"):
                 self.last_input = self.maxima.after
                 s = self.maxima.before.lstrip("\n").rstrip()
-                while c.endswith(";") and s == "":
-                    self.expect(r"\(%i\d+\)")
-                    if self.maxima.before.startswith(c + "\n"):
-                        self.maxima.before = self.maxima.before[len(c) + 1 :]
+                while (
+                    c.endswith(";")
+                    and s == ""
+                    and not self.interrupted
+                    and len(pipelined) == 0
+                ):
+                    self.expect(r"\(%i\d+\)", timeout)
+                    if self.maxima.before.startswith(sent + "\n"):
+                        self.maxima.before = self.maxima.before[len(sent) + 1 :]
                     s = self.maxima.before.lstrip("\n").rstrip()
                 if debug:
                     print('    s = "{}"'.format(s))
@@ -550,6 +1487,7 @@ class Maxima(object):
                             s = c + "\n" + s
                     else:
                         l_output = 0
+                    self.update_cache(c, sent, None)
                     continue
                 i = len(s) - 5
                 m = None
@@ -559,6 +1497,7 @@ class Maxima(object):
                         break
                     else:
                         i -= 1
+                self.update_cache(c, sent, m[2].strip() if m else None)
                 if re.match(
                     r"(for|thru|while|unless) |(s?print|printf|display) *\(", c
                 ):
@@ -569,6 +1508,8 @@ class Maxima(object):
                     else:
                         s = self.modify_output(s, remove_new_lines=False)
                     l_output = len(s)
+                    if not replace:  # 入力のブロックと区別できるように
+                        s = "/* PRINT: */\n" + s
                 elif m:  # re.match(r'(\(%o\d+\))(.*)', s[i:])
                     if c.startswith("? ") or self.in_help:
                         l_output = 0
@@ -620,6 +1561,7 @@ class Maxima(object):
                     + "\n\n"
                 )
                 self.in_help = True
+                self.update_cache(c, sent, None)
                 return outputs, 0
             else:
                 # example: sum(x^i, i, 0, inf), simpsum;
@@ -628,216 +1570,451 @@ class Maxima(object):
                 if i is not None:
                     self.maxima.after = self.maxima.after[i.end() :]
                 outputs.append(self.maxima.after.strip() + "\n\n")
+                self.update_cache(c, sent, None)
                 return outputs, 0
         self.last_input = "/* " + self.last_input.strip() + ": */"
         return outputs, l_output  # l_output is used for selection range in a display
 
-    @staticmethod
-    def remove_redundant_parentheses(s):
-        debug = False
-        if debug:
-            print("remove_redundant_parentheses")
-            print('    initial string = "{}"'.format(s))
-        if len(s) == 0:
-            return "", 0, ""
-        priority = {
-            "=": 1000,  # equation start point
-            "!!": 100,
-            "!": 90,  # a!!! = (a!!)!
-            "^^": 80,  # a^^b! = a^^(b!)
-            "^": 80,  # a^b! = a^(b!)
-            "**": 80,  # a**b! = a**(b!)
-            ".": 70,  # a.b^c = a.(b^c)
-            "/": 60,  # a/b.c = a/(b.c)
-            "*": 59,  # a*b.c = a*(b.c), conversion (a*b)/c = a*b/c is done by adding another condition
-            "+": 50,  # a + b*c = a + (b*c)
-            "-": 50,  # a + b*c = a + (b*c)
-        }
-        if s[0] == "-":
-            min_priority = last_priority = priority["*"]
-            r = "-"
-            s = s[1:]
-        else:
-            min_priority = last_priority = priority["="]
-            r = ""
-        pat = re.compile(
-            r'(?P<string>"(?:[^"\\]|\\.)*")'
-            "|"
-            r"(?P<operator>!!?|\^\^?|\*\*?|\.(?![0-9])|[/+\-=])"
-            "|"  # 書き換えたらpat_operatorも書き換える
-            r"(?:(?P<function>[a-zA-Z_][a-zA-Z_0-9\[\]]*)\()"
-            "|"  # parenthesis_startよりも前！
-            r"(?P<parenthesis_start>\()"
-            "|"  # functionよりも後！
-            r"(?P<parenthesis_end>\))"
-            "|"
-            r"(?P<bracket_start>\[)"
-            "|"
-            r"(?P<bracket_end>\])"
-        )
-        pat_operator = re.compile(
-            r"!!?|\^\^?|\*\*?|\.(?![0-9])|[/+\-=]"
-        )  # 書き換えたらpat_operatorの?P<operator>も書き換える
-        while len(s) > 0:
-            if debug:
-                print('    while, s = "{}"'.format(s))
-            m = pat.search(s)
-            if not m:
-                r += s
-                if debug:
-                    print('    no operator/function/(, r = "{}"'.format(r))
-                break
-            if m.lastgroup == "string":
-                r += s[: m.end()]
-                s = s[m.end() :]
-                if debug:
-                    print('    skip string, r = "{}"'.format(r))
-            elif m.lastgroup == "operator":
-                last_priority = priority[m.group()]
-                if (
-                    r.endswith("^") and s[0] == "-"
-                ):  # not update min_priority in the case of a^-b
-                    pass
-                elif min_priority > last_priority:
-                    min_priority = last_priority
-                r += s[: m.end()]
-                s = s[m.end() :]
-                if debug:
-                    print(
-                        "    operator {}, min_priority = {}".format(
-                            m.group(), min_priority
-                        )
-                    )
-            elif m.group("function") is not None:
-                if debug:
-                    print('    function = "{}", '.format(m.group("function")))
-                r += s[: m.end()]
-                inside, _, s = Maxima.remove_redundant_parentheses(s[m.end() :])
-                if (
-                    m.group() == "diff"
-                    and inside.endswith(",1")
-                    and inside[:-2].count(",") == 1
-                ):
-                    r += inside[:-2] + ")"
-                else:
-                    r += inside + ")"
-                if debug:
-                    print('    function, r = "{}", '.format(r))
-            elif m.lastgroup == "parenthesis_start":
-                r += s[: m.end() - 1]  # string before '('
-                if debug:
-                    print("    (")
-                    print('        r = "{}"'.format(r))
-                inside, inside_priority, s = Maxima.remove_redundant_parentheses(
-                    s[m.end() :]
-                )
-                if debug:
-                    print(
-                        '        inside = "{}", inside_priority = {}, s = "{}"'.format(
-                            inside, inside_priority, s
-                        )
-                    )
-                m = pat_operator.match(s)
-                if m:
-                    if debug:
-                        print('        following operator = "{}"'.format(m.group()))
-                    if not r.endswith("%e^-") and (
-                        (
-                            last_priority == priority["="]
-                            or last_priority <= inside_priority
-                        )
-                        and (
-                            inside_priority >= priority[m.group()]
-                            or inside_priority == priority["*"]
-                            and m.group() == "/"
-                        )
-                    ):  # conversion (a*b)/c = a*b/c is done here
-                        if r.endswith("+") and inside.startswith("-"): # +- -> -
-                            r = r[:-1]
-                        r += inside + s[: m.end()]
-                    else:  # append parentheses in the case of %e^-(a*b)
-                        r += "(" + inside + ")" + s[: m.end()]
-                    last_priority = priority[m.group()]
-                    if min_priority > last_priority:
-                        min_priority = last_priority
-                    s = s[m.end() :]
-                else:  # no operator follows after a closing parenthesis
-                    if debug:
-                        print(f"        no following operator, r = {r}")
-                    if not r.endswith("%e^-") and last_priority <= inside_priority:
-                        r += inside
-                    else:  # append parentheses in the case of %e^-(a*b)
-                        r += "(" + inside + ")"
-                if debug:
-                    print(
-                        '        r = "{}", min_priority = "{}"'.format(r, min_priority)
-                    )
-            elif m.lastgroup == "parenthesis_end":
-                r += s[: m.end() - 1]  # string before ')'
-                if debug:
-                    print('    ), r = "{}", remainder = "{}"'.format(r, s[m.end() :]))
-                return r, min_priority, s[m.end() :]
-            elif m.lastgroup == "bracket_start":
-                r += s[: m.end()]  # string until '['
-                if debug:
-                    print("    [")
-                    print('        r = "{}"'.format(r))
-                inside, _, s = Maxima.remove_redundant_parentheses(s[m.end() :])
-                r += inside  # including ']'
-                if debug:
-                    print('        r = "{}"'.format(r))
-            elif m.lastgroup == "bracket_end":
-                r += s[: m.end()]  # string until ']'
-                if debug:
-                    print('    ], r = "{}", remainder = "{}"'.format(r, s[m.end() :]))
-                return r, min_priority, s[m.end() :]
-        if debug:
-            print('    return, r = "{}", min_priority = {}'.format(r, min_priority))
-        return r, min_priority, ""
-
     def modify_output(self, s, remove_new_lines=True):
         debug = False
         if debug:
             print('modify_output 0 = "{}"'.format(s))
-        if remove_new_lines:
-            # r'"(\\.|[^"])*"' -> string enclosed in double quotes
-            s = resub_outside((r" *\n *", ""), s, r'"(\\.|[^"])*"').strip()
-        s = resub_outside(
-            (
-                (" ", ""),  # remove spaces
-                (r"'?([_A-Za-z][_A-Za-z0-9]*)\(", r"\1("),
-            ),  # 'func( -> func(
-            s,
-            r'"(\\.|[^"])*"',
+        # 文字列の外の空白（と改行）を取り除く
+        s = self.output_spaces[remove_new_lines].sub(
+            lambda m: m.group(1) or "", s
         )
+        if remove_new_lines:
+            s = s.strip()
+        s = self.output_quote.sub(lambda m: m.group(1) or "", s)  # 'func( -> func(
         if debug:
             print('modify_output 1 = "{}"'.format(s))
-        s = self.remove_redundant_parentheses(s)[0]
+        s = "\n".join(minimize_parentheses(l) for l in s.split("\n"))
         if debug:
             print('modify_output 2 = "{}"'.format(s))
-        s = resub_outside(
-            (
-                (r"([^(^\[=,])-", r"\1 - "),
-                (r"([+=])", r" \1 "),
-                (",", ", "),
-                (r"([^_A-Za-z](?:[0-9]+\.?|\.[0-9]+)[eb]) ([-+]) ([0-9])", r"\1\2\3"),
-            ),  # 1.0e + 10 -> 1.0e+10
-            s,
-            r'"(\\.|[^"])*"',
-        )
+        s = self.output_operator.sub(self.space_operator, s)
+        s = self.output_exponent.sub(
+            lambda m: m.group(1) or m.group(2) + m.group(3) + m.group(4), s
+        )  # 1.0e + 10 -> 1.0e+10
         if debug:
             print('modify_output 3 = "{}"'.format(s))
         return s
 
+    @staticmethod
+    def space_operator(m):
+        if m.group(1) is not None:  # string
+            return m.group(1)
+        elif m.group(2) is not None:  # a-b -> a - b
+            return (" + " if m.group(2) == "+" else m.group(2)) + " - "
+        elif m.group() == ",":
+            return ", "
+        else:  # + =
+            return " " + m.group() + " "
+
     def __del__(self):
-        try:
-            self.maxima.sendline("quit();")
-        except:
-            pass
-        if sys.platform == "win32":
-            self.maxima.kill(0)
+        if self.own_pool:
+            self.pool.close()
+        close_maxima(self.maxima)
+
+
+class TextModel(object):
+    # MyTextCtrlの内容の写し．文字列を断片のリストとして持ち，断片ごとの文字数と
+    # 改行の数をFenwick木に入れて，位置や行の検索と編集をO(log n)で行う
+    chunk_length = 4096  # 断片の長さは，これの1/4倍から2倍まで
+
+    def __init__(self, value=""):
+        self.set_value(value)
+
+    def set_value(self, value):
+        n = self.chunk_length
+        self.chunks = [value[i : i + n] for i in range(0, len(value), n)] or [""]
+        self.rebuild()
+
+    def rebuild(self):
+        n = len(self.chunks)
+        self.lengths = [0] + [len(c) for c in self.chunks]  # Fenwick木, 1から始まる
+        self.newlines = [0] + [c.count("\n") for c in self.chunks]
+        self.length = sum(self.lengths)
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                self.lengths[j] += self.lengths[i]
+                self.newlines[j] += self.newlines[i]
+        self.step = 1
+        while self.step * 2 <= n:
+            self.step *= 2
+
+    def add(self, i, length, newlines):
+        # i番目の断片の文字数と改行の数を増やす
+        i += 1
+        while i < len(self.lengths):
+            self.lengths[i] += length
+            self.newlines[i] += newlines
+            i += i & -i
+
+    def prefix(self, tree, i):
+        # i番目より前の断片の合計
+        s = 0
+        while i > 0:
+            s += tree[i]
+            i -= i & -i
+        return s
+
+    def search(self, tree, x):
+        # 合計がxを超える最初の断片の番号と，それより前の断片の合計
+        i = 0
+        s = 0
+        step = self.step
+        while step > 0:
+            if i + step < len(tree) and s + tree[i + step] <= x:
+                i += step
+                s += tree[i]
+            step //= 2
+        return i, s
+
+    def locate(self, pos):
+        # posが何番目の断片の何文字目か
+        i, s = self.search(self.lengths, pos)
+        if i == len(self.chunks):  # 末尾
+            i -= 1
+            s -= len(self.chunks[i])
+        return i, pos - s
+
+    def replace(self, start, end, value):
+        n = self.chunk_length
+        i, a = self.locate(start)
+        j, b = self.locate(end)
+        v = self.chunks[i][:a] + value + self.chunks[j][b:]
+        self.length += len(value) - (end - start)
+        if i == j and (n // 4 <= len(v) <= 2 * n or len(self.chunks) == 1):
+            self.add(
+                i,
+                len(v) - len(self.chunks[i]),
+                v.count("\n") - self.chunks[i].count("\n"),
+            )
+            self.chunks[i] = v
+            return
+        if len(v) < n // 4 and j + 1 < len(self.chunks):  # 短すぎるので次とつなげる
+            j += 1
+            v += self.chunks[j]
+        self.chunks[i : j + 1] = [v[k : k + n] for k in range(0, len(v), n)]
+        if len(self.chunks) == 0:
+            self.chunks.append("")
+        self.rebuild()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, s):
+        # 切り出しだけできる
+        start, end, _ = s.indices(self.length)
+        if start >= end:
+            return ""
+        i, a = self.locate(start)
+        r = []
+        l = end - start
+        while l > 0:
+            r.append(self.chunks[i][a : a + l])
+            l -= len(r[-1])
+            i += 1
+            a = 0
+        return "".join(r)
+
+    def get_value(self):
+        return "".join(self.chunks)
+
+    def line_start(self, pos):
+        # posを含む行の先頭の位置．v.rfind("\n", 0, pos) + 1と同じ
+        i, a = self.locate(pos)
+        k = self.chunks[i].rfind("\n", 0, a)
+        if k != -1:
+            return pos - a + k + 1
+        k = self.prefix(self.newlines, i)  # それより前の改行の数
+        if k == 0:
+            return 0
+        i, _ = self.search(self.newlines, k - 1)
+        return self.prefix(self.lengths, i) + self.chunks[i].rfind("\n") + 1
+
+    def line_end(self, pos):
+        # pos以降で最初の改行の位置．なければ末尾
+        i, a = self.locate(pos)
+        k = self.chunks[i].find("\n", a)
+        if k != -1:
+            return pos - a + k
+        k = self.prefix(self.newlines, i + 1)
+        if k == self.prefix(self.newlines, len(self.chunks)):
+            return self.length
+        i, _ = self.search(self.newlines, k)
+        return self.prefix(self.lengths, i) + self.chunks[i].find("\n")
+
+    def line_number(self, pos):
+        # posを含む行の番号．v.count("\n", 0, pos)と同じ
+        i, a = self.locate(pos)
+        return self.prefix(self.newlines, i) + self.chunks[i].count("\n", 0, a)
+
+    def line_position(self, n):
+        # n番目の行の先頭の位置
+        if n == 0:
+            return 0
+        i, k = self.search(self.newlines, n - 1)
+        a = -1
+        for _ in range(n - k):
+            a = self.chunks[i].find("\n", a + 1)
+        return self.prefix(self.lengths, i) + a + 1
+
+
+class LevelLexer(object):
+    # かっこ，文字列，行コメントの深さを調べる．区切りをまとめた正規表現で探して，
+    # 開いているものをstackに積むので，再帰せずに1回の走査で済む
+    def __init__(
+        self, parentheses=None, literals=None, literal_escape="", line_comments=None
+    ):
+        # example of parentheses: (('(', ')'), ('{', '}'), ('[', ']'))
+        # example of literals: (('"', '"'), ("'", "'"))
+        # example of line_comments: ('#',  "//")
+        # example of literal_escape: '\\'
+        if parentheses is None:
+            parentheses = tuple()
+        elif not isinstance(parentheses[0], (tuple, list)):
+            parentheses = (parentheses,)
+        if literals is None:
+            literals = tuple()
+        elif not isinstance(literals[0], (tuple, list)):
+            literals = (literals,)
+        if line_comments is None:
+            line_comments = tuple()
+        elif not isinstance(line_comments, (tuple, list)):
+            line_comments = (line_comments,)
+        escape = re.escape(literal_escape) + r"[\s\S]?" if literal_escape else None
+        # 元の実装と同じく，コメント，文字列，かっこの順に調べる
+        tokens = [
+            (re.escape(i) + r"[^\n\r]*[\n\r]?", "comment", None) for i in line_comments
+        ]
+        for i in literals:
+            if i[0]:
+                tokens.append((re.escape(i[0]), "literal", i[1]))
+        if escape is not None and len(literals) > 0:
+            tokens.append((escape, "escape", None))
+        for i in parentheses:
+            if i[0]:
+                tokens.append((re.escape(i[0]), "open", i[1]))
+            if i[1]:
+                tokens.append((re.escape(i[1]), "close", None))
+        self.patterns = {None: self.compile(tokens)}  # {文字列の終わり: ...}, Noneは文字列の外
+        for i in literals:
+            t = [(re.escape(i[1]), "close", None)]
+            if escape is not None:
+                t.insert(0, (escape, "escape", None))
+            self.patterns[i[1]] = self.compile(t)
+
+    @staticmethod
+    def compile(tokens):
+        # 正規表現と，グループの番号ごとの(種類, 終わり)
+        if len(tokens) == 0:
+            return None, None
+        return (
+            re.compile("|".join("(" + t[0] + ")" for t in tokens)),
+            [None] + [(t[1], t[2]) for t in tokens],
+        )
+
+    def lex(self, string, pos=0, end=None, stack=(), brackets=None):
+        # string[pos:end]を[開始, 終了, 深さ]に分けたリストと，endでのstackを返す．
+        # stackは開いているものの(種類, 終わり)のタプル．行ごとに続きから調べられる．
+        # bracketsには文字列やコメントの外のかっこを(開始, 終了, 始まりか, 対応するか)で加える
+        if end is None:
+            end = len(string)
+        stack = list(stack)
+        levels = []
+        start = pos
+        while pos < end:
+            pattern, kinds = self.patterns[
+                stack[-1][1] if len(stack) > 0 and stack[-1][0] == "literal" else None
+            ]
+            m = None if pattern is None else pattern.search(string, pos, end)
+            if m is None:
+                break
+            kind, closer = kinds[m.lastindex]
+            i, pos = m.span()
+            if kind == "escape":
+                continue
+            elif kind == "close":
+                if len(stack) == 0:  # 始まりが見つからずに，いきなり終わりが見つかった
+                    continue
+                if brackets is not None and stack[-1][0] == "open":
+                    brackets.append((i, pos, False, m.group() == stack[-1][1]))
+                levels.append([start, pos, len(stack)])
+                start = pos
+                del stack[-1]
+                continue
+            if start < i:
+                levels.append([start, i, len(stack)])
+            if kind == "comment":
+                levels.append([i, pos, len(stack) + 1])
+                start = pos
+            else:
+                if brackets is not None and kind == "open":
+                    brackets.append((i, pos, True, True))
+                start = i
+                stack.append((kind, closer))
+        if start < end:
+            levels.append([start, end, len(stack)])
+        return levels, tuple(stack)
+
+
+class LevelColorizer(object):
+    # 行頭でのstackを行ごとに覚えておき，編集された行から，stackが前と一致する
+    # ところまでだけ調べ直す
+    def __init__(self, lexer, text):
+        self.lexer = lexer
+        self.text = text  # TextModel
+        self.states = [()] + [None] * text.line_number(len(text))  # 行頭でのstack
+        self.first = 0  # 調べ直す最初の行．Noneなら済んだ
+        self.last = len(self.states) - 1  # この行までは必ず調べ直す
+
+    def replace(self, l0, l1, newlines):
+        # l0行目からl1行目までを，改行をnewlines個含むものに置き換えた
+        self.states[l0 + 1 : l1 + 1] = [None] * newlines
+        if self.first is None:
+            self.first, self.last = l0, l0 + newlines
         else:
-            self.maxima.close()
+            self.first = min(self.first, l0)
+            if self.last > l1:
+                self.last += newlines - (l1 - l0)
+            else:
+                self.last = max(self.last, l0 + newlines)
+
+    def lex_line(self, k, line, stack):
+        return self.lexer.lex(line, stack=stack)
+
+    def run(self, limit):
+        # 調べ直した範囲の[開始, 終了, 深さ]を返す．limit文字ほど調べたら中断する
+        levels = []
+        k = self.first
+        if k is None:
+            return levels
+        pos = self.text.line_position(k)
+        stack = self.states[k]
+        n = 0
+        while True:
+            end = min(self.text.line_end(pos) + 1, len(self.text))
+            l, stack = self.lex_line(k, self.text[pos:end], stack)
+            for i in l:
+                i[0] += pos
+                i[1] += pos
+            levels.extend(l)
+            n += end - pos + 1
+            pos = end
+            k += 1
+            if k == len(self.states) or (k > self.last and self.states[k] == stack):
+                self.first = None  # これより後は前と変わらない
+                break
+            self.states[k] = stack
+            if n >= limit:  # k行目の行頭が変わったかもしれないので，k行目は必ず調べ直す
+                self.first = k
+                self.last = max(self.last, k)
+                break
+        return levels
+
+
+class BracketIndex(LevelColorizer):
+    # 行ごとのかっこを覚えておき，編集された行だけ調べ直す．対応は使う時にまとめて求め，
+    # 次の編集まで使い回す
+    def __init__(self, lexer, text):
+        LevelColorizer.__init__(self, lexer, text)
+        self.brackets = [None] * len(self.states)  # 行ごとの，行頭からのかっこの位置
+        self.opens = None  # 始まりの位置の順に並べた対応
+
+    def replace(self, l0, l1, newlines):
+        self.brackets[l0 + 1 : l1 + 1] = [None] * newlines
+        self.brackets[l0] = None
+        LevelColorizer.replace(self, l0, l1, newlines)
+        self.opens = None
+
+    def lex_line(self, k, line, stack):
+        brackets = []
+        levels, stack = self.lexer.lex(line, stack=stack, brackets=brackets)
+        self.brackets[k] = brackets
+        return levels, stack
+
+    def match(self):
+        while self.first is not None:
+            self.run(sys.maxsize)
+        self.opens = []  # 始まりの位置
+        self.closes = []  # 終わりの位置．Noneなら閉じていない
+        self.ends = []  # 終わりの後の位置
+        self.matched = []  # 始まりと終わりが対応する種類か
+        self.parents = []  # 外側の対応の番号
+        stack = []
+        pos = 0
+        for k, b in enumerate(self.brackets):
+            if len(b) == 0:
+                continue
+            pos = self.text.line_position(k)
+            for i in b:
+                if i[2]:
+                    self.opens.append(pos + i[0])
+                    self.closes.append(None)
+                    self.ends.append(None)
+                    self.matched.append(True)
+                    self.parents.append(stack[-1] if len(stack) > 0 else -1)
+                    stack.append(len(self.opens) - 1)
+                else:
+                    j = stack.pop()
+                    self.closes[j] = pos + i[0]
+                    self.ends[j] = pos + i[1]
+                    self.matched[j] = i[3]
+
+    def enclosing(self, selection):
+        # selectionを囲む最も内側のかっこの範囲．対応しない場合はNone
+        if self.opens is None:
+            self.match()
+        j = bisect.bisect_left(self.opens, selection[0]) - 1
+        while j >= 0:  # selectionより前で最後に始まるかっこから外側へ
+            if self.closes[j] is not None and self.closes[j] >= selection[1]:
+                return [self.opens[j], self.ends[j]] if self.matched[j] else None
+            j = self.parents[j]
+        return None
+
+
+class Operation(object):
+    # 元に戻す・やり直すための編集．長い文字列は圧縮して持つ
+    __slots__ = ("pos", "_old", "_new", "packed")
+    pack_length = 4096  # これ以上の長さの文字列を圧縮する
+
+    def __init__(self, pos, old, new):
+        self.pos = pos
+        self.packed = 0  # 1: oldを圧縮した, 2: newを圧縮した
+        self.old = old
+        self.new = new
+
+    def pack(self, s, bit):
+        if len(s) < self.pack_length:
+            self.packed &= ~bit
+            return s
+        self.packed |= bit
+        return zlib.compress(s.encode("UTF-8"), 1)
+
+    def unpack(self, s, bit):
+        return zlib.decompress(s).decode("UTF-8") if self.packed & bit else s
+
+    @property
+    def old(self):
+        return self.unpack(self._old, 1)
+
+    @old.setter
+    def old(self, s):
+        self._old = self.pack(s, 1)
+
+    @property
+    def new(self):
+        return self.unpack(self._new, 2)
+
+    @new.setter
+    def new(self, s):
+        self._new = self.pack(s, 2)
+
+    @property
+    def size(self):  # バイト
+        return sys.getsizeof(self) + sys.getsizeof(self._old) + sys.getsizeof(self._new)
 
 
 class MyTextCtrl(wx.TextCtrl):
@@ -851,6 +2028,9 @@ class MyTextCtrl(wx.TextCtrl):
         (192, 192, 192),  # silver
         (255, 0, 255),  # fuchsia magenta
     )
+    colorize_limit = 65536  # 一度に色付けし直す文字数
+    load_chunk = 1024 * 1024  # ファイルを少しずつ読み込む時のバイト数
+    large_file_size = 64 * 1024 * 1024  # これより大きいファイルは読み取り専用で開く
     str_menu_wo_shortcut = _("通常入力モード")
     str_menu_with_shortcut = _("コマンドショートカットモード")
     str_wo_shortcut = _(
@@ -1008,11 +2188,31 @@ class MyTextCtrl(wx.TextCtrl):
             self.SetFont(self.font)
             self.SetDefaultStyle(wx.TextAttr(wx.NullColour, font=self.font))
         self.maxima = Maxima()
+        self.side_maximas = []  # すべてのブロックを並列に評価する時に使う
+        self.evaluated_hashes = set()  # 評価したブロックのハッシュ
+        self.session_definers = {}  # {symbol: いつものMaximaで最後に定義したブロックのハッシュ}
+        self.maxima_spans = []  # Maximaの評価中に編集されても追従させる範囲
+        self.output_spans = []  # 挿入したMaximaの出力の範囲．編集に追従させる
         self.shortcut = False
-        self.last_value = self.GetValue()  # unicode
-        self.operations = [[0, "", self.last_value]]
+        v = self.GetValue()  # unicode
+        self.text = TextModel(v)  # 内容の写し．編集ごとに差分で更新する
+        self.operations = [Operation(0, "", v)]
         self.operation_index = len(self.operations)
-        self.record_op = True
+        self.operations_size = self.operations[0].size  # バイト
+        self.undo_budget = 64 * 1024 * 1024  # 元に戻すための履歴に使うメモリ（バイト）
+        self.unrecorded = None  # 記録しなかった編集をまとめたもの
+        self.known_edit = False  # 編集の内容が分かっているので，OnTextで調べなくてよい
+        self.transaction = 0  # begin_operationの入れ子の深さ
+        self.transaction_record = False  # end_operationで記録する
+        self.loading = None  # 読み込み中のファイルの印
+        self.read_only = False  # 大きなファイルを開いた
+        self.on_load_status = None  # 読み込みの状態が変わるとメインスレッドで呼ばれる
+        self.on_loaded = None  # 読み込みが終わるとメインスレッドで呼ばれる
+        self.colorizer = None  # 編集に合わせて色付けし直す
+        self.colorize_styles = []
+        self.colorize_scheduled = False
+        self.bracket_index = None  # select_bracketで使う
+        self.bracket_syntax = None
         self.completion_from = None
         self.completion_candidates = []
         self.completion_index = 0
@@ -1033,22 +2233,106 @@ class MyTextCtrl(wx.TextCtrl):
     def shorten(self, s):
         return s if len(s) <= 23 else s[:10] + "..." + s[-10:]
 
-    def record_operation(self):
+    def guess_edit(self):
+        # キャレットの周りだけを比べて，どこがどう書き換わったかを調べる．分からなければ広げる
+        v = self.text
+        l = self.GetLastPosition()
+        d = l - len(v)
+        h = min(self.GetInsertionPoint(), l)
+        w = 256
+        while True:
+            start = max(0, h - w - max(d, 0))
+            end = min(l, h + w)
+            r = str_diff(v[start : end - d], self.GetRange(start, end))
+            if (start == 0 or r[0] > 0) and (
+                end == l or r[0] + len(r[2]) < end - start
+            ):
+                r[0] += start
+                return r
+            w *= 4
+
+    def apply_edit(self, d, record_op):
+        # 編集d = [pos, old, new]をtextとMaximaの範囲に反映させて記録する
+        if d[1] == "" and d[2] == "":
+            return
+        self.replace_text(d[0], d[0] + len(d[1]), d[2])
+        for span in self.maxima_spans + self.output_spans:
+            shift_span(span, d[0], len(d[1]), len(d[2]))
+        if record_op:
+            self.record_operation(d)
+        else:
+            self.unrecorded = compose_edits(self.unrecorded, d, self.text)
+
+    def replace_text(self, start, end, value):
+        # textを更新し，色付けやかっこの対応で調べ直す行を覚えておく
+        if self.colorizer is None and self.bracket_index is None:
+            self.text.replace(start, end, value)
+            return
+        l0, l1 = self.text.line_number(start), self.text.line_number(end)
+        self.text.replace(start, end, value)
+        if self.bracket_index is not None:
+            self.bracket_index.replace(l0, l1, value.count("\n"))
+        if self.colorizer is None:
+            return
+        self.colorizer.replace(l0, l1, value.count("\n"))
+        if not self.colorize_scheduled:
+            self.colorize_scheduled = True
+            wx.CallAfter(self.colorize_pending)
+
+    def edit(self, function, start, end, new, record_op):
+        # startからendまでをnewに置き換える編集をする．startがNoneの時や食い違う時は調べる
+        self.known_edit = True
+        function()
+        self.known_edit = False
+        if self.transaction > 0:  # textはend_operationでまとめて更新する
+            self.transaction_record = self.transaction_record or record_op
+            if start is not None:
+                for span in self.maxima_spans + self.output_spans:
+                    shift_span(span, start, end - start, len(new))
+            return
+        l = len(self.text)
+        if start is None or self.GetLastPosition() != l - (end - start) + len(new):
+            d = self.guess_edit()
+        else:
+            d = [start, self.text[start:end], new]
+        self.apply_edit(d, record_op)
+
+    def begin_operation(self):
+        # end_operationまでの編集を，まとめて1つの操作として記録する．
+        # 例外で抜けても閉じるように，end_operationはfinallyで呼ぶ
+        self.transaction += 1
+
+    def end_operation(self):
+        self.transaction -= 1
+        if self.transaction > 0:
+            return
+        v = self.GetValue()  # unicode
+        d = str_diff(self.text.get_value(), v)
+        self.replace_text(d[0], d[0] + len(d[1]), d[2])
+        if self.transaction_record:
+            self.record_operation(d)
+        else:
+            self.unrecorded = compose_edits(self.unrecorded, d, v)
+        self.transaction_record = False
+
+    def record_operation(self, d=None):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
-        v = self.GetValue()  # unicode
-        d = str_diff(self.last_value, v)
+        if self.unrecorded is not None:  # 記録しなかった編集もまとめて記録する
+            if d is not None:
+                d = compose_edits(self.unrecorded, d, self.text)
+            else:
+                d = self.unrecorded
+            self.unrecorded = None
+        if d is None:
+            self.operation_index = len(self.operations)
+            return
+        r = str_diff(d[1], d[2])
+        d = [d[0] + r[0], r[1], r[2]]
         if d[1] == "" and d[2] == "":
             self.operation_index = len(self.operations)
             return
         if self.debug:
-            print(
-                '{}: "{}" -> "{}"'.format(
-                    sys._getframe().f_code.co_name,
-                    self.shorten(self.last_value),
-                    self.shorten(v),
-                )
-            )
             print(
                 "{}: d = {}".format(
                     sys._getframe().f_code.co_name,
@@ -1056,12 +2340,14 @@ class MyTextCtrl(wx.TextCtrl):
                 )
             )
         l = self.operations[-1]
+        size = l.size
         if (
             self.operation_index == len(self.operations)
-            and l[1] == ""
+            and l.packed == 0
+            and l.old == ""
             and d[1] == ""
             and len(d[2]) == 1
-            and l[0] + len(l[2]) == d[0]
+            and l.pos + len(l.new) == d[0]
         ):
             #                                l[0]    l[0] + len(l[2])
             #                                 |             |
@@ -1069,13 +2355,15 @@ class MyTextCtrl(wx.TextCtrl):
             # d: [i_d, '', 'a'             ]                a
             #                                               |
             #                                              d[0]
-            l[2] += d[2]
+            l.new += d[2]
+            self.operations_size += l.size - size
         elif (
             self.operation_index == len(self.operations)
-            and l[2] == ""
+            and l.packed == 0
+            and l.new == ""
             and d[2] == ""
             and len(d[1]) == 1
-            and d[0] + len(d[1]) == l[0]
+            and d[0] + len(d[1]) == l.pos
         ):
             #                                 l[0]
             #                                  |
@@ -1084,60 +2372,86 @@ class MyTextCtrl(wx.TextCtrl):
             #                                 ||
             #                                /  \
             #                             d[0]  d[0] + len(d[1])
-            l[0] = d[0]
-            l[1] = d[1] + l[1]
+            l.pos = d[0]
+            l.old = d[1] + l.old
+            self.operations_size += l.size - size
         else:
-            self.operations.append(d)
-            if len(self.operations) > 100:
-                del self.operations[: len(self.operations) - 100]
+            self.operations.append(Operation(*d))
+            self.operations_size += self.operations[-1].size
+            # 古いものから，使うメモリがundo_budget以下になるまで捨てる
+            i = 0
+            while (
+                self.operations_size > self.undo_budget
+                and i < len(self.operations) - 1
+            ):
+                self.operations_size -= self.operations[i].size
+                i += 1
+            del self.operations[:i]
             self.operation_index = len(self.operations)
         if self.debug:
             print(
                 "{}: operations = {}".format(
                     sys._getframe().f_code.co_name,
                     [
-                        [i[0], self.shorten(i[1]), self.shorten(i[2])]
+                        [i.pos, self.shorten(i.old), self.shorten(i.new)]
                         for i in self.operations
                     ],
                 )
             )
-        self.last_value = v  # unicode
 
     def WriteText(self, text, record_op=True):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
-        self.record_op = record_op
-        super(MyTextCtrl, self).WriteText(text)
-        self.record_op = True
+        s = self.GetSelection()  # 選択範囲は置き換えられる
+        self.edit(
+            lambda: super(MyTextCtrl, self).WriteText(text),
+            s[0],
+            s[1],
+            text,
+            record_op,
+        )
 
     def SetValue(self, value, record_op=True):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
-        self.record_op = record_op
-        super(MyTextCtrl, self).SetValue(value)
-        self.record_op = True
+        self.edit(
+            lambda: super(MyTextCtrl, self).SetValue(value),
+            0,
+            self.GetLastPosition(),
+            value,
+            record_op,
+        )
 
     def Replace(self, from_, to_, value, record_op=True):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
-        self.record_op = record_op
-        super(MyTextCtrl, self).Replace(from_, to_, value)
-        self.record_op = True
+        self.edit(
+            lambda: super(MyTextCtrl, self).Replace(from_, to_, value),
+            from_,
+            to_,
+            value,
+            record_op,
+        )
 
     def Remove(self, from_, to_, record_op=True):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
-        self.record_op = record_op
-        super(MyTextCtrl, self).Remove(from_, to_)
-        self.record_op = True
+        self.edit(
+            lambda: super(MyTextCtrl, self).Remove(from_, to_),
+            from_,
+            to_,
+            "",
+            record_op,
+        )
 
     def Cut(self, record_op=True):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
-        self.record_op = record_op
-        super(MyTextCtrl, self).Cut()
+        s = self.GetSelection()
+        self.edit(
+            lambda: super(MyTextCtrl, self).Cut(), s[0], s[1], "", record_op
+        )
         pyperclip.copy(pyperclip.paste())
-        self.record_op = True
 
     def Copy(self):
         if self.debug:
@@ -1148,16 +2462,16 @@ class MyTextCtrl(wx.TextCtrl):
     def Paste(self, record_op=True):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
-        self.record_op = record_op
         pyperclip.copy(pyperclip.paste())
-        super(MyTextCtrl, self).Paste()
-        self.record_op = True
+        self.edit(
+            lambda: super(MyTextCtrl, self).Paste(), None, None, None, record_op
+        )
 
     def OnText(self, event):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
-        if self.record_op:
-            self.record_operation()
+        if not self.known_edit and self.transaction == 0:  # キー入力など
+            self.apply_edit(self.guess_edit(), True)
         if self.font is not None:
             self.SetFont(self.font)
             self.SetDefaultStyle(wx.TextAttr(wx.NullColour, font=self.font))
@@ -1274,13 +2588,14 @@ class MyTextCtrl(wx.TextCtrl):
             else:
                 event.Skip()
         else:
-            self.record_op = True
             event.Skip()
             if (
                 self.completion_from is not None
                 and event.GetModifiers() != wx.MOD_SHIFT
             ):
                 self.completion_from = None
+                if self.unrecorded is not None:  # 補完した語を1つの操作として記録する
+                    self.record_operation()
 
     def OnPaste(self, event):
         # 貼り付け時はIMEが絡まないので、これまで通りプレーンテキスト化
@@ -1303,23 +2618,24 @@ class MyTextCtrl(wx.TextCtrl):
             self.record_operation()
         self.operation_index -= 1
         o = self.operations[self.operation_index]
+        pos, old, new = o.pos, o.old, o.new
         if self.debug:
             print(
                 '{}: "{}" -> "{}"'.format(
                     sys._getframe().f_code.co_name,
-                    self.shorten(o[2]),
-                    self.shorten(o[1]),
+                    self.shorten(new),
+                    self.shorten(old),
                 )
             )
-            if o[2] != self.GetRange(o[0], o[0] + len(o[2])):
+            if new != self.GetRange(pos, pos + len(new)):
                 print(
                     '{}: !!!!! "{}" != "{}"'.format(
                         sys._getframe().f_code.co_name,
-                        o[2],
-                        self.GetRange(o[0], o[0] + len(o[2])),
+                        new,
+                        self.GetRange(pos, pos + len(new)),
                     )
                 )
-        self.Replace(o[0], o[0] + len(o[2]), o[1], record_op=False)
+        self.Replace(pos, pos + len(new), old, record_op=False)
 
     def Redo(self):
         if self.debug:
@@ -1328,69 +2644,201 @@ class MyTextCtrl(wx.TextCtrl):
         if self.operation_index == len(self.operations):
             return
         o = self.operations[self.operation_index]
+        pos, old, new = o.pos, o.old, o.new
         if self.debug:
             print(
                 '{}: "{}" -> "{}"'.format(
                     sys._getframe().f_code.co_name,
-                    self.shorten(o[1]),
-                    self.shorten(o[2]),
+                    self.shorten(old),
+                    self.shorten(new),
                 )
             )
-            if o[1] != self.GetRange(o[0], o[0] + len(o[1])):
+            if old != self.GetRange(pos, pos + len(old)):
                 print(
                     '{}: !!!!! "{}" != "{}"'.format(
                         sys._getframe().f_code.co_name,
-                        o[1],
-                        self.GetRange(o[0], o[0] + len(o[1])),
+                        old,
+                        self.GetRange(pos, pos + len(old)),
                     )
                 )
-        self.Replace(o[0], o[0] + len(o[1]), o[2], record_op=False)
+        self.Replace(pos, pos + len(old), new, record_op=False)
         self.operation_index += 1
 
     def LoadFile(self, filename, fileType=wx.TEXT_TYPE_ANY):
+        # 文字コードと改行コードは先頭から推定してすぐに返し，中身は別のスレッドで
+        # 少しずつ読み込んで追加する
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
+        size = os.path.getsize(filename)
         with open(filename, "rb") as f:
-            s = f.read()
+            head = f.read(65536)
+            tail = b""
+            if size > 2 * 65536:
+                f.seek((size - 65536) & ~1)  # UTF-16でも文字の境目から
+                tail = f.read()
+            char_code, return_code = detect_codes(head, tail, size <= 65536)
+        self.read_only = size > self.large_file_size
+        self.SetEditable(False)
+        self.SetValue("", record_op=False)
+        self.start_loading(filename, size, char_code, return_code)
+        return char_code, return_code
+
+    def start_loading(self, filename, size, char_code, return_code):
+        token = self.loading = object()
+        chunks = queue.Queue(4)  # 読み込んだが，まだ追加していないもの
+        t = threading.Thread(
+            target=self.read_file,
+            args=(token, chunks, filename, size, char_code, return_code),
+        )
+        t.daemon = True
+        t.start()
+
+    def read_file(self, token, chunks, filename, size, char_code, return_code):
+        # 別のスレッドで，mmapしたファイルを少しずつ変換してメインスレッドに渡す
         try:
-            s = s.decode("UTF-8")  # unicode
-            char_code = "UTF-8"
-        except:
-            s = s.decode("CP932")  # unicode
-            char_code = "CP932"
-        if s.find("\r\n") != -1:
-            return_code = "CR+LF"
-            s = s.replace("\r\n", "\n").replace("\r", "\n")
-        elif s.find("\r") != -1:
-            return_code = "CR"
-            s = s.replace("\r", "\n")
+            try:
+                newlines = self.read_chunks(
+                    token, chunks, filename, size, char_code, return_code
+                )
+            except UnicodeDecodeError:  # 先頭と末尾はUTF-8に見えたが，途中が違った
+                char_code = "CP932"
+                chunks.put((None, 0))  # 読み込んだ分を捨てる
+                wx.CallAfter(self.append_loaded, token, chunks, size)
+                newlines = self.read_chunks(
+                    token, chunks, filename, size, char_code, return_code
+                )
+        except Exception as e:  # 読めなくても，読み込み中のままにしない
+            wx.CallAfter(self.fail_loading, token, e)
+            return
+        if newlines is not None:
+            wx.CallAfter(
+                self.finish_loading, token, char_code, return_code, len(newlines) > 1
+            )
+
+    def read_chunks(self, token, chunks, filename, size, char_code, return_code):
+        # 現れた改行コードを返す．中止した場合はNone
+        newlines = set()
+        if size == 0:
+            return newlines
+        decoder = codecs.getincrementaldecoder(char_code)(
+            "strict" if char_code.startswith("UTF-8") else "replace"
+        )
+        rest = ""  # \r\nの途中で切れた\r
+        with open(filename, "rb") as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for i in range(0, size, self.load_chunk):
+                    if token is not self.loading:  # 別のファイルを開いた
+                        return None
+                    last = i + self.load_chunk >= size
+                    v = rest + decoder.decode(m[i : i + self.load_chunk], last)
+                    rest = ""
+                    if v.endswith("\r") and not last:
+                        v, rest = v[:-1], "\r"
+                    newlines.update(k for k, n in count_newlines(v).items() if n > 0)
+                    if return_code == "CR+LF":
+                        v = v.replace("\r\n", "\n").replace("\r", "\n")
+                    elif return_code == "CR":
+                        v = v.replace("\r", "\n")
+                    chunks.put((v, min(i + self.load_chunk, size)))  # 溜まりすぎたら待つ
+                    wx.CallAfter(self.append_loaded, token, chunks, size)
+            finally:
+                m.close()
+        return newlines
+
+    def append_loaded(self, token, chunks, size):
+        v, done = chunks.get()  # 印が古くても取り出して，読み込みのスレッドを止めない
+        if token is not self.loading:
+            return
+        if v is None:
+            self.SetValue("", record_op=False)
+            return
+        self.known_edit = True
+        super(MyTextCtrl, self).AppendText(v)
+        self.known_edit = False
+        self.replace_text(len(self.text), len(self.text), v)
+        if self.on_load_status is not None:
+            self.on_load_status(_("読み込み中") + " {}%".format(done * 100 // max(size, 1)))
+
+    def fail_loading(self, token, error):
+        if self.debug:
+            print("----- " + sys._getframe().f_code.co_name + " -----")
+        if token is not self.loading:
+            return
+        # 途中まで読んだものを保存すると元のファイルが壊れるので，空にして編集できるようにする
+        self.loading = None
+        self.read_only = False
+        self.SetValue("", record_op=False)
+        self.operations = [Operation(0, "", "")]
+        self.operation_index = len(self.operations)
+        self.operations_size = self.operations[0].size
+        self.unrecorded = None
+        self.SetModified(False)
+        self.SetEditable(True)
+        if self.on_load_status is not None:
+            self.on_load_status(_("読み込み失敗"))
+        with wx.MessageDialog(
+            None,
+            _("{}\nファイルを読み込めませんでした．").format(error),
+            _("例外発生"),
+            style=wx.ICON_ERROR,
+        ) as md:
+            md.ShowModal()
+
+    def finish_loading(self, token, char_code, return_code, mixed):
+        if self.debug:
+            print("----- " + sys._getframe().f_code.co_name + " -----")
+        if token is not self.loading:
+            return
+        self.loading = None
+        if self.read_only:  # 大きなファイルは元に戻す対象にしない
+            self.operations = [Operation(0, "", "")]
+            self.operation_index = len(self.operations)
+            self.operations_size = self.operations[0].size
+            self.unrecorded = None
         else:
-            return_code = "LF"
-        self.SetValue(s)
-        return char_code, return_code
+            self.record_operation([0, "", self.text.get_value()])
+        self.SetModified(False)
+        self.SetEditable(not self.read_only)
+        if self.on_load_status is not None:
+            # CR+LFやCRのファイルでは，他の改行も\nにそろえて読み込むので，保存すると
+            # 改行コードが変わる．LFのファイルでは\rが残るので，そのまま保存される
+            status = []
+            if self.read_only:
+                status.append(_("読み取り専用"))
+            if mixed and return_code != "LF":
+                status.append(
+                    _("改行コードが混在．保存すると{}にそろえます").format(return_code)
+                )
+            elif mixed:
+                status.append(_("改行コードが混在"))
+            self.on_load_status("，".join(status))
+        if self.on_loaded is not None:
+            self.on_loaded(char_code, return_code)
 
     def completion(self):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
         if self.completion_from is None:
             s = self.GetSelection()
-            v = self.GetValue()  # unicode
-            i = s[0] - 1
+            start = self.text.line_start(s[0])  # 語は行をまたがない
+            v = self.text[start : s[1]]  # unicode
+            i = s[0] - start - 1
             while True:
                 if i < 0:
-                    self.completion_from = 0
+                    self.completion_from = start
                     break
                 elif v[i] in r"/\%+-^_?:":
-                    self.completion_from = i
+                    self.completion_from = start + i
                     break
                 elif (
                     v[i]
                     not in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
                 ):
-                    self.completion_from = i + 1
+                    self.completion_from = start + i + 1
                     break
                 i -= 1
-            p = v[self.completion_from : s[1]]
+            p = v[self.completion_from - start :]
             if len(p) == 0:
                 self.completion_from = None
                 return
@@ -1435,12 +2883,90 @@ class MyTextCtrl(wx.TextCtrl):
 #            self.SetSelection(self.completion_from, self.GetInsertionPoint())
             self.completion_index += 1
 
+    def evaluate_async(self, commands, span, function, replace=False, maxima=None):
+        # spanとキャレットの位置は評価中に編集されても追従させ，評価後にfunctionを呼ぶ
+        if maxima is None:
+            maxima = self.maxima
+        caret = list(self.GetSelection())
+        provisional = [span[1], span[1]]  # 評価中に表示する出力
+        self.maxima_spans.extend((span, caret, provisional))
+        maxima.submit(
+            lambda r: self.on_evaluated(span, caret, provisional, function, r),
+            maxima.evaluate,
+            commands,
+            replace,
+            None,
+            None if replace else lambda lines: self.stream_output(provisional, lines),
+        )
+
+    def stream_output(self, provisional, lines):
+        # 評価中の出力を仮に表示する．記録はせず，評価が終わったら消す
+        if provisional[0] == provisional[1]:
+            v = "\n\n/* PRINT: */\n" + "\n".join(lines)
+        else:
+            v = "\n" + "\n".join(lines)
+        i, j = provisional
+        s = shift_span(list(self.GetSelection()), j, 0, len(v))
+        self.Replace(j, j, v, record_op=False)
+        provisional[:] = [i, j + len(v)]
+        self.SetSelection(*s)
+
+    def on_evaluated(self, span, caret, provisional, function, r):
+        self.maxima_spans = [
+            i
+            for i in self.maxima_spans
+            if i is not span and i is not caret and i is not provisional
+        ]
+        if provisional[0] < provisional[1] and r is not None:
+            s = shift_span(
+                list(self.GetSelection()),
+                provisional[0],
+                provisional[1] - provisional[0],
+                0,
+            )
+            self.Remove(provisional[0], provisional[1], record_op=False)
+            caret[:] = shift_span(
+                caret, provisional[0], provisional[1] - provisional[0], 0
+            )
+            self.SetSelection(*s)
+        if r is not None:
+            # キャレットが評価を始めた時の位置から動いていなければ，結果を選択する
+            function(span, list(self.GetSelection()) == caret, *r)
+
+    def replace_span(self, span, value, follow, selection):
+        # selectionはvalueの中で選択する範囲
+        s = shift_span(
+            list(self.GetSelection()), span[0], span[1] - span[0], len(value)
+        )
+        self.Replace(span[0], span[1], value)
+        if follow:
+            self.SetSelection(span[0] + selection[0], span[0] + selection[1])
+        else:
+            self.SetSelection(*s)
+
+    def insert_outputs(self, span, follow, last_input, outputs, l_output):
+        i, j = span
+        self.begin_operation()  # 入力の番号と出力を1つの操作として記録する
+        try:
+            self.replace_span([i, i], last_input + "\n", False, None)
+            j += len(last_input) + 1
+            v = "\n\n" + "\n\n".join(outputs) if len(outputs) > 0 else ""
+            if follow and len(outputs) == 0:
+                self.SetInsertionPoint(j)
+            else:
+                self.replace_span([j, j], v, follow, (len(v) - l_output, len(v)))
+            if v != "":  # 空行を含む出力もあるので，ブロックを分ける時に使う
+                self.output_spans = [i for i in self.output_spans if i[0] < i[1]]
+                self.output_spans.append([j, j + len(v)])
+        finally:
+            self.end_operation()
+
     def send_commands_to_maxima(self):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
         s = self.GetSelection()
         if s[0] == s[1]:
-            v = self.GetValue()  # unicode
+            v = self.text.get_value()  # unicode
             # a + b;\n
             # \n
             # b + c;\n
@@ -1456,40 +2982,242 @@ class MyTextCtrl(wx.TextCtrl):
             if j == -1:
                 j = len(v.rstrip())
             commands = v[i:j]
-            m = re.match(r"(?:/\* \(%i\d+\): \*/\n)+", commands)
-            if m:
-                commands = commands[m.end() :]
-                self.Remove(i, i + m.end(), record_op=False)
-                j -= m.end()
+            function = self.insert_outputs
+            blocks = self.maxima_blocks(v, self.output_spans)
+            for k, b in enumerate(blocks):
+                if i <= b[0] and b[2] <= j:  # 変更されたブロックを評価し直す時のために記録する
+                    dependency = block_dependencies(self.block_commands(v, blocks))[k]
+
+                    def function(span, follow, last_input, outputs, l_output):
+                        self.record_block(dependency)
+                        self.insert_outputs(span, follow, last_input, outputs, l_output)
+
+                    break
+            self.begin_operation()  # 入力の番号を消して;を付けるのを1つの操作にする
+            try:
+                m = re.match(r"(?:/\* \(%i\d*\): \*/\n)+", commands)
+                if m:
+                    commands = commands[m.end() :]
+                    self.Remove(i, i + m.end(), record_op=False)
+                    j -= m.end()
+                if commands != "" and commands[-1] not in ";$":
+                    self.SetInsertionPoint(j)
+                    self.WriteText(";")
+                    j += 1
+            finally:
+                self.end_operation()
             if commands == "":
                 return
-            elif commands[-1] not in ";$":
-                self.SetInsertionPoint(j)
-                self.WriteText(";")
-                j += 1
-            self.SetInsertionPoint(i)
-            self.WriteText(self.maxima.last_input + "\n")
-            self.SetInsertionPoint(j + len(self.maxima.last_input) + 1)
-            try:
-                outputs, l_output = self.maxima.send_commands(commands)
-                if len(outputs) > 0:
-                    self.WriteText("\n\n" + "\n\n".join(outputs))
-                    j = self.GetInsertionPoint()
-                    self.SetSelection(j - l_output, j)
-            except:
-#                print(sys.exc_info())
-                pass
+            self.SetInsertionPoint(j)
+            self.evaluate_async(commands, [i, j], function)
         else:
-            try:
-                outputs, l_output = self.maxima.send_commands(
-                    self.GetStringSelection(), replace=True
+
+            def replace(span, follow, last_input, outputs, l_output):
+                v = "\n".join(outputs)
+                self.replace_span(span, v, follow, (len(v) - l_output, len(v)))
+
+            self.evaluate_async(
+                self.GetStringSelection(), list(s), replace, replace=True
+            )
+
+    def evaluate_all_blocks(self):
+        if self.debug:
+            print("----- " + sys._getframe().f_code.co_name + " -----")
+        # 以前の出力を取り除いてから，互いに独立なブロックの組を別々のMaximaで評価する
+        v = self.text.get_value()  # unicode
+        blocks = self.maxima_blocks(v, self.output_spans)
+        commands = self.block_commands(v, blocks)
+        spans = self.remove_outputs(v, blocks, commands, range(len(blocks)))
+        components = independent_blocks(commands)
+        if len(components) == 0:
+            return
+        dependencies = block_dependencies(commands)
+        self.evaluated_hashes = set()
+        # 最も大きな組はいつものMaximaで評価し，残りは評価時間が揃うように振り分ける
+        main = max(components, key=lambda c: (len(c), c[-1]))
+        components.remove(main)
+        components.sort(key=len, reverse=True)
+        sides = [
+            [] for i in range(min(len(components), multiprocessing.cpu_count() - 1))
+        ]
+        for c in components:
+            min(sides, key=len).extend(c)
+        if len(sides) == 0:
+            main = range(len(blocks))
+
+        def insert(dependency, numbered=True):
+            def function(span, follow, last_input, outputs, l_output):
+                self.record_block(dependency)
+                if not numbered:
+                    # 別のMaximaの番号はいつものMaximaの%oNと合わないので消す
+                    last_input, outputs = strip_label_numbers(last_input, outputs)
+                self.insert_outputs(span, False, last_input, outputs, l_output)
+
+            return function
+
+        for i in sorted(main):
+            self.evaluate_async(commands[i], spans[i], insert(dependencies[i]))
+        for side in sides:
+            maxima = Maxima(self.maxima.pool, self.maxima.cache, self.maxima.cache_lock)
+            self.side_maximas.append(maxima)
+            for i in sorted(side):
+                self.evaluate_async(
+                    commands[i], spans[i], insert(dependencies[i], False), maxima=maxima
                 )
-                self.Replace(s[0], s[1], "\n".join(outputs))
-                j = self.GetInsertionPoint()
-                self.SetSelection(j - l_output, j)
-            except:
-#                print(sys.exc_info())
+            # 評価し終えたら，定義をいつものMaximaに読み込ませる
+            facts = ""
+            for i in side:
+                for m in re.finditer(
+                    r"\b(assume|forget|declare|depends|gradef)\s*\(", commands[i]
+                ):
+                    a = maxima_arguments(commands[i], m.end() - 1)
+                    facts += "{}({})$".format(m.group(1), a)
+            fd, path = tempfile.mkstemp(".lisp", "texteditwx_")
+            os.close(fd)
+            maxima.submit(
+                lambda r, maxima=maxima, path=path, facts=facts: self.on_side_evaluated(
+                    maxima, path, facts, r
+                ),
+                maxima.save_state,
+                path,
+            )
+
+    @staticmethod
+    def maxima_blocks(v, outputs=()):
+        # 入力のブロックごとに[ラベルの開始位置, 入力の開始位置, 入力の終了位置, 出力の終了位置]を返す．
+        # outputsは挿入した出力の範囲．エラーやprintの出力は空行を含むので，範囲の
+        # 分からない出力（ファイルから読んだものなど）は，次の入力のラベルまでを出力とみなす
+        outputs = sorted(o for o in outputs if o[0] < o[1])
+        starts = [o[0] for o in outputs]
+        blocks = []
+        continued = False  # 範囲の分からない出力の続き
+        i = 0
+        for b in v.split("\n\n"):
+            j = i + len(b)
+            start = i + len(b) - len(b.lstrip("\n"))
+            end = j - (len(b) - len(b.rstrip("\n")))
+            b = b.strip("\n")
+            k = bisect.bisect_right(starts, start) - 1
+            m = re.match(
+                r"/\* (\(%o\d*\)|ERROR|WARNING|HELP|EXAMPLE|lisp|PRINT):? \*/\n", b
+            )
+            if b == "":
                 pass
+            elif k >= 0 and start < outputs[k][1]:
+                if len(blocks) > 0:
+                    blocks[-1][3] = end
+                continued = False
+            elif m or continued and not re.match(r"/\* \(%i\d*\): \*/\n", b):
+                if len(blocks) > 0:
+                    blocks[-1][3] = end
+                if m:  # 式の出力は空行を含まない．printの出力は式の出力で終わる
+                    continued = not m.group(1).startswith("(%o")
+            elif re.sub(r"/\*(\*(?!/)|[^*])*\*/", "", b).strip() != "":
+                m = re.match(r"(?:/\* \(%i\d*\): \*/\n)+", b)
+                blocks.append([start, start + m.end() if m else start, end, end])
+                continued = False
+            i = j + 2
+        return blocks
+
+    @staticmethod
+    def block_commands(v, blocks):
+        commands = []
+        for b in blocks:
+            c = v[b[1] : b[2]]
+            commands.append(c if c[-1] in ";$" else c + ";")
+        return commands
+
+    def remove_outputs(self, v, blocks, commands, indices):
+        # indicesのブロックの入力ラベルと以前の出力を後ろから消し，;を補う．
+        # 消した後の入力の範囲を{index: [start, end]}で返す．それ以外の所は書き換えない
+        spans = {}
+        s = list(self.GetSelection())
+        self.begin_operation()
+        try:
+            for k in sorted(set(indices), reverse=True):
+                start, i, j, end = blocks[k]
+                if j < end:
+                    self.Remove(j, end, record_op=False)
+                    shift_span(s, j, end - j, 0)
+                if v[j - 1] not in ";$":
+                    self.Replace(j, j, ";", record_op=False)
+                    shift_span(s, j, 0, 1)
+                if start < i:
+                    self.Remove(start, i, record_op=False)
+                    shift_span(s, start, i - start, 0)
+                for span in spans.values():
+                    shift_span(span, start, end - start, len(commands[k]))
+                spans[k] = [start, start + len(commands[k])]
+        finally:
+            self.end_operation()
+        self.SetSelection(*s)
+        return spans
+
+    def record_block(self, dependency):
+        # いつものMaximaで評価したブロックを記録する
+        self.evaluated_hashes.add(dependency[0])
+        for n in dependency[1]:
+            self.session_definers[n] = dependency[0]
+
+    def reevaluate_stale_blocks(self):
+        if self.debug:
+            print("----- " + sys._getframe().f_code.co_name + " -----")
+        # 評価した後に変更されたブロックと，それに依存するブロックだけを評価し直す
+        v = self.text.get_value()  # unicode
+        blocks = self.maxima_blocks(v, self.output_spans)
+        commands = self.block_commands(v, blocks)
+        dependencies = block_dependencies(commands)
+        stale = [
+            k
+            for k, d in enumerate(dependencies)
+            if d[0] not in self.evaluated_hashes
+        ]
+        if len(stale) == 0:
+            return
+        if any(dependencies[k][4] for k in stale):
+            self.evaluate_all_blocks()
+            return
+        order = schedule_blocks(stale, dependencies, self.session_definers)
+        spans = self.remove_outputs(v, blocks, commands, stale)
+
+        def insert(dependency):
+            def function(span, follow, last_input, outputs, l_output):
+                self.record_block(dependency)
+                self.insert_outputs(span, False, last_input, outputs, l_output)
+
+            return function
+
+        for k, kills in order:
+            if k in spans:
+                span = spans.pop(k)
+                self.evaluate_async(kills + commands[k], span, insert(dependencies[k]))
+            else:  # 状態を戻すために評価し直すだけで，出力はそのまま
+                dependency = dependencies[k]
+                self.maxima.submit(
+                    lambda r, dependency=dependency: self.record_block(dependency)
+                    if r is not None
+                    else None,
+                    self.maxima.evaluate,
+                    kills + commands[k],
+                )
+
+    def on_side_evaluated(self, maxima, path, facts, r):
+        maxima.quit()
+        self.side_maximas.remove(maxima)
+
+        def remove(r):
+            if os.path.isfile(path):
+                os.remove(path)
+
+        if r is None:  # 中断された
+            remove(r)
+        else:
+            self.maxima.submit(remove, self.maxima.restore_state, path, facts)
+
+    def cancel_maxima(self):
+        for maxima in self.side_maximas:
+            maxima.interrupt()
+        self.maxima.interrupt()
 
     def set_negative(self):
         if self.debug:
@@ -1497,103 +3225,67 @@ class MyTextCtrl(wx.TextCtrl):
         s = self.GetSelection()
         if s[0] != s[1]:
             ss = self.GetStringSelection()
-            try:
-                v = "\n".join(
-                    self.maxima.send_commands("-(" + ss + ")", replace=True)[0]
-                )
+
+            def replace(span, follow, last_input, outputs, l_output):
+                v = "\n".join(outputs)
                 if ss[0] == "(" and ss[-1] == ")":
                     v = "(" + v + ")"
-                self.Replace(s[0], s[1], v)
-                self.SetSelection(s[0], s[0] + len(v))
-            except:
-#                print(sys.exc_info())
-                pass
+                self.replace_span(span, v, follow, (0, len(v)))
+
+            self.evaluate_async("-(" + ss + ")", list(s), replace, replace=True)
 
     def set_reciprocal(self):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
         s = self.GetSelection()
         if s[0] != s[1]:
-            try:
-                v = "\n".join(
-                    self.maxima.send_commands(
-                        "1/(" + self.GetStringSelection() + ")", replace=True
-                    )[0]
-                )
-                self.Replace(s[0], s[1], v)
-                self.SetSelection(s[0], s[0] + len(v))
-            except:
-#                print(sys.exc_info())
-                pass
+
+            def replace(span, follow, last_input, outputs, l_output):
+                v = "\n".join(outputs)
+                self.replace_span(span, v, follow, (0, len(v)))
+
+            self.evaluate_async(
+                "1/(" + self.GetStringSelection() + ")", list(s), replace, replace=True
+            )
+
+    def replace_inside_parentheses(self, commands):
+        # 選択部分が丸括弧でくくられていれば，括弧の内側を置き換える
+        s = list(self.GetSelection())
+        w = self.GetStringSelection()
+        if w[0] == "(" and w[-1] == ")":
+            s[0] += 1
+            s[1] -= 1
+
+        def replace(span, follow, last_input, outputs, l_output):
+            v = "\n".join(outputs)
+            self.replace_span(span, v, follow, (0, len(v)))
+
+        self.evaluate_async(commands, s, replace, replace=True)
 
     def multiply(self, multiplier):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
-        s = list(self.GetSelection())
+        s = self.GetSelection()
         if s[0] != s[1]:
-            try:
-                v = "\n".join(
-                    self.maxima.send_commands(
-                        "multthru("
-                        + multiplier
-                        + ","
-                        + self.GetStringSelection()
-                        + ")",
-                        replace=True,
-                    )[0]
-                )
-                w = self.GetStringSelection()
-                if w[0] == "(" and w[-1] == ")":
-                    s[0] += 1
-                    s[1] -= 1
-                self.Replace(s[0], s[1], v)
-                self.SetSelection(s[0], s[0] + len(v))
-            except:
-#                print(sys.exc_info())
-                pass
+            self.replace_inside_parentheses(
+                "multthru(" + multiplier + "," + self.GetStringSelection() + ")"
+            )
 
     def plus(self, additive):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
-        s = list(self.GetSelection())
+        s = self.GetSelection()
         if s[0] != s[1]:
-            try:
-                v = "\n".join(
-                    self.maxima.send_commands(
-                        additive + "+" + self.GetStringSelection(), replace=True
-                    )[0]
-                )
-                w = self.GetStringSelection()
-                if w[0] == "(" and w[-1] == ")":
-                    s[0] += 1
-                    s[1] -= 1
-                self.Replace(s[0], s[1], v)
-                self.SetSelection(s[0], s[0] + len(v))
-            except:
-#                print(sys.exc_info())
-                pass
+            self.replace_inside_parentheses(additive + "+" + self.GetStringSelection())
 
     def power(self, exponent):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
-        s = list(self.GetSelection())
+        s = self.GetSelection()
         if s[0] != s[1]:
-            try:
-                v = "\n".join(
-                    self.maxima.send_commands(
-                        "(" + self.GetStringSelection() + ")^(" + exponent + ")",
-                        replace=True,
-                    )[0]
-                )
-                w = self.GetStringSelection()
-                if w[0] == "(" and w[-1] == ")":
-                    s[0] += 1
-                    s[1] -= 1
-                self.Replace(s[0], s[1], v)
-                self.SetSelection(s[0], s[0] + len(v))
-            except:
-#                print(sys.exc_info())
-                pass
+            self.replace_inside_parentheses(
+                "(" + self.GetStringSelection() + ")^(" + exponent + ")"
+            )
 
     def exchange_hands(self):
         if self.debug:
@@ -1622,8 +3314,28 @@ class MyTextCtrl(wx.TextCtrl):
             self.Replace(s[0], s[1], v)
             self.SetInsertionPoint(s[0] + len(v))
 
-    def select_bracket(self, parentheses):
-        r = str_range_between(self.GetValue(), self.GetSelection(), parentheses)
+    def visible_range(self):
+        # 表示されているおおよその範囲．分からなければ挿入位置の前後
+        try:
+            w, h = self.GetClientSize()
+            r0, a = self.HitTestPos(wx.Point(0, 0))
+            r1, b = self.HitTestPos(wx.Point(w - 1, h - 1))
+            if wx.TE_HT_UNKNOWN not in (r0, r1):
+                return a, self.text.line_end(max(a, b))
+        except:
+            pass
+        p = self.GetInsertionPoint()
+        return max(p - 10000, 0), p + 10000
+
+    def select_bracket(
+        self, parentheses, literals=None, literal_escape="", line_comments=None
+    ):
+        # 文字列とコメントの中のかっこは数えない
+        syntax = (parentheses, literals, literal_escape, line_comments)
+        if self.bracket_syntax != syntax:
+            self.bracket_index = BracketIndex(LevelLexer(*syntax), self.text)
+            self.bracket_syntax = syntax
+        r = self.bracket_index.enclosing(self.GetSelection())
         if r is None:
             print("\a")  # beep
         else:
@@ -1632,24 +3344,50 @@ class MyTextCtrl(wx.TextCtrl):
     def colorize_texts(
         self, parentheses=None, literals=None, literal_escape="", line_comments=None
     ):
-        for i in str_levels(
-            self.GetValue(), parentheses, literals, literal_escape, line_comments
-        ):
-            j = i[2] % len(self.colors)
-            self.SetStyle(
-                i[0],
-                i[1],
-                wx.TextAttr(
-                    wx.Colour(
-                        self.colors[j][0], self.colors[j][1], self.colors[j][2], 255
-                    )
-                ),
-            )
+        # 以後は編集するたびに，変わったところだけ色付けし直す
+        self.colorizer = LevelColorizer(
+            LevelLexer(parentheses, literals, literal_escape, line_comments), self.text
+        )
+        self.colorize_styles = [
+            wx.TextAttr(wx.Colour(i[0], i[1], i[2], 255)) for i in self.colors
+        ]
+        self.colorize_scheduled = True
+        self.colorize_pending()
+
+    def colorize_pending(self):
+        # 大きなファイルでは少しずつ色付けして，続きは後で行う
+        self.colorize_scheduled = False
+        if self.colorizer is None:
+            return
+        if self.transaction > 0:  # textがまだ更新されていない
+            self.colorize_scheduled = True
+            wx.CallAfter(self.colorize_pending)
+            return
+        styles = self.colorize_styles
+        start = end = j = None
+        self.Freeze()  # まとめて一度だけ描き直す
+        try:
+            for i in self.colorizer.run(self.colorize_limit):
+                k = i[2] % len(styles)
+                if k == j and i[0] == end:  # 同じ色が続くところはまとめる
+                    end = i[1]
+                    continue
+                if j is not None:
+                    self.SetStyle(start, end, styles[j])
+                start, end, j = i[0], i[1], k
+            if j is not None:
+                self.SetStyle(start, end, styles[j])
+        finally:
+            self.Thaw()
+        if self.colorizer.first is not None:
+            self.colorize_scheduled = True
+            wx.CallAfter(self.colorize_pending)
 
     def reset_styles(self):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
-        self.SetStyle(0, len(self.GetValue()), wx.TextAttr(wx.BLACK, wx.WHITE))
+        self.colorizer = None
+        self.SetStyle(0, len(self.text), wx.TextAttr(wx.BLACK, wx.WHITE))
         if self.font is not None:
             self.SetDefaultStyle(wx.TextAttr(wx.NullColour, font=self.font))
 
@@ -1681,12 +3419,9 @@ class MyTextCtrl(wx.TextCtrl):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
         s = list(self.GetSelection())
-        v = self.GetValue()
-        s[0] = v.rfind("\n", 0, s[0]) + 1
-        s[1] = v.find("\n", max(s[1] - 1, s[0]))
-        if s[1] == -1:
-            s[1] = len(v)
-        v = re.sub(r"(^|\n)", r"\1" + indenter, v[s[0] : s[1]])
+        s[0] = self.text.line_start(s[0])
+        s[1] = self.text.line_end(max(s[1] - 1, s[0]))
+        v = re.sub(r"(^|\n)", r"\1" + indenter, self.text[s[0] : s[1]])
         if self.font is not None:
             self.SetFont(self.font)
             self.SetDefaultStyle(wx.TextAttr(wx.NullColour, font=self.font))
@@ -1697,15 +3432,13 @@ class MyTextCtrl(wx.TextCtrl):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
         s = list(self.GetSelection())
-        v = self.GetValue()
-        s[0] = v.rfind("\n", 0, s[0]) + 1
-        s[1] = v.find("\n", s[1])
-        if s[1] == -1:
-            s[1] = len(v)
+        s[0] = self.text.line_start(s[0])
+        s[1] = self.text.line_end(s[1])
+        v = self.text[s[0] : s[1]]
         if indenter is None:
-            v = re.sub(r"(^|\n)[^\n]", r"\1", v[s[0] : s[1]])
+            v = re.sub(r"(^|\n)[^\n]", r"\1", v)
         else:
-            v = re.sub(r"(^|\n)" + indenter, r"\1", v[s[0] : s[1]])
+            v = re.sub(r"(^|\n)" + indenter, r"\1", v)
         if self.font is not None:
             self.SetFont(self.font)
             self.SetDefaultStyle(wx.TextAttr(wx.NullColour, font=self.font))
@@ -1719,7 +3452,7 @@ class MyTextCtrl(wx.TextCtrl):
         if s[0] != s[1]:
             v = w = self.GetStringSelection()
         else:
-            v = w = self.GetValue()
+            v = w = self.text.get_value()
         while True:
             w, n = re.subn(r"((?:^|\n)\s*)[ 　]{4}", r"\1\t", w)
             if n == 0:
@@ -1738,7 +3471,7 @@ class MyTextCtrl(wx.TextCtrl):
         if s[0] != s[1]:
             v = w = self.GetStringSelection()
         else:
-            v = w = self.GetValue()
+            v = w = self.text.get_value()
         while True:
             w, n = re.subn(r"((?:^|\n)\s*)\t", r"\1    ", w)
             if n == 0:
@@ -1757,7 +3490,7 @@ class MyTextCtrl(wx.TextCtrl):
         if s[0] != s[1]:
             v = w = self.GetStringSelection()
         else:
-            v = w = self.GetValue()
+            v = w = self.text.get_value()
         w = re.sub(r"[ \t]+(\n|$)", r"\1", w)
         if v != w:
             if s[0] != s[1]:
@@ -1773,7 +3506,7 @@ class MyTextCtrl(wx.TextCtrl):
         if s[0] != s[1]:
             v = w = self.GetStringSelection()
         else:
-            v = w = self.GetValue()
+            v = w = self.text.get_value()
         if method == "upper":
             w = v.upper()
         elif method == "lower":
@@ -1801,17 +3534,16 @@ class MyTextCtrl(wx.TextCtrl):
         if self.debug:
             print("----- " + sys._getframe().f_code.co_name + " -----")
         s = list(self.GetSelection())
-        v = self.GetValue()
-        s[0] = v.rfind("\n", 0, s[0]) + 1
-        s[1] = v.find("\n", max(s[1] - 1, s[0]))
-        if s[1] == -1:
-            s[1] = len(v)
-        v = line_numbered_str(v[s[0] : s[1]], head, prefix, suffix)
+        s[0] = self.text.line_start(s[0])
+        s[1] = self.text.line_end(max(s[1] - 1, s[0]))
+        v = line_numbered_str(self.text[s[0] : s[1]], head, prefix, suffix)
         self.Replace(s[0], s[1], v)
         self.SetSelection(s[0], s[0] + len(v))
 
     def reset_maxima(self):
-        self.maxima.reset()
+        self.evaluated_hashes = set()
+        self.session_definers = {}
+        self.maxima.submit(None, self.maxima.reset)
 
     def __del__(self):
         try:
@@ -2100,21 +3832,219 @@ class GridWithCellToolTip(wx.grid.Grid):
             self.table.SetValue(self.GetGridCursorRow(), col, pyperclip.paste())
             self.ForceRefresh()
 
-    def Cut(self):
-        col = self.GetGridCursorCol()
-        if self.table.data_types[col] == wx.grid.GRID_VALUE_STRING:
-            row = self.GetGridCursorRow()
-            pyperclip.copy(self.table.GetValue(row, col))
-            self.table.SetValue(row, col, None)
-            self.ForceRefresh()
+    def Cut(self):
+        col = self.GetGridCursorCol()
+        if self.table.data_types[col] == wx.grid.GRID_VALUE_STRING:
+            row = self.GetGridCursorRow()
+            pyperclip.copy(self.table.GetValue(row, col))
+            self.table.SetValue(row, col, None)
+            self.ForceRefresh()
+
+
+###########################################################################
+## Class DialogFind
+###########################################################################
+
+
+class FindEngine(object):
+    # TableForFindの検索対象の行をコンパイルしたもの．正規表現でない行はまとめて
+    # 一つの正規表現にして一度に探す．同じ位置で見つかる場合は上の行を優先する
+    def __init__(self, rows, col_re, col_find, ignore_case):
+        self.rows = rows
+        self.literals = []  # [(行の順番, コンパイルした正規表現)]
+        self.patterns = []  # [(行の順番, コンパイルした正規表現)]
+        self.compiled = []  # 行ごとのコンパイルした正規表現
+        flags = re.I if ignore_case else 0
+        for k, i in enumerate(rows):
+            if i[col_re]:  # 大文字小文字を無視するかは正規表現で指定する
+                self.compiled.append(re.compile(i[col_find]))
+                self.patterns.append((k, self.compiled[-1]))
+            else:
+                self.compiled.append(re.compile(re.escape(i[col_find]), flags))
+                self.literals.append((k, self.compiled[-1]))
+        # 選択肢をグループで囲むと，先頭の文字で絞り込む最適化が効かなくなる
+        self.literal = (
+            re.compile("|".join(c.pattern for k, c in self.literals), flags)
+            if self.literals
+            else None
+        )
+
+    def search(self, v, pos=0, endpos=None):
+        # pos以降で最初に見つかる[開始, 終了, 行]．見つからなければNone
+        if endpos is None:
+            endpos = len(v)
+        found = None
+        if self.literal is not None:
+            m = self.literal.search(v, pos, endpos)
+            if m:  # その位置で一致する最初の行が，選ばれた選択肢
+                for k, c in self.literals:
+                    n = c.match(v, m.start(), endpos)
+                    if n:
+                        found = (m.start(), k, n.end())
+                        break
+        for k, c in self.patterns:
+            m = c.search(v, pos, endpos)
+            if m and (found is None or (m.start(), k) < found[:2]):
+                found = (m.start(), k, m.end())
+        if found is None:
+            return None
+        return [found[0], found[2], self.rows[found[1]]]
+
+    def matches(self, v):
+        # 左から一度だけ走査して，重ならないものを(開始, 終了, 行の順番, match)で返す．
+        # heapには行ごとに次に見つかるものを入れておき，前のものと重なった行だけ探し直す
+        heap = []
+        for k, c in enumerate(self.compiled):
+            m = c.search(v)
+            if m:
+                heap.append((m.start(), k, m.end(), m))
+        heapq.heapify(heap)
+        pos = 0  # ここまで調べた
+        while len(heap) > 0:
+            start, k, end, m = heapq.heappop(heap)
+            if start >= pos:
+                yield start, end, k, m
+                pos = end if start < end else end + 1  # 空文字列に一致したら1文字進める
+            if pos <= len(v):
+                m = self.compiled[k].search(v, pos)
+                if m:
+                    heapq.heappush(heap, (m.start(), k, m.end(), m))
+
+    def replace_all(self, v, col_replace, col_re):
+        return self.replace_all_n(v, col_replace, col_re)[0]
+
+    def replace_all_n(self, v, col_replace, col_re):
+        # 置き換えた文字列と置き換えた数
+        r = []
+        pos = 0  # ここまで出力した
+        n = 0
+        for start, end, k, m in self.matches(v):
+            i = self.rows[k]
+            s = "" if i[col_replace] is None else i[col_replace]
+            r.append(v[pos:start])
+            r.append(m.expand(s) if i[col_re] and "\\" in s else s)
+            pos = end
+            n += 1
+        r.append(v[pos:])
+        return "".join(r), n
+
+    def search_backward(self, v, end, start=0):
+        # endより前で最後に始まる[開始, 終了, 行]．endを越える部分は探さない．
+        # endの手前から範囲を広げながら，行ごとに範囲内で最後に始まるものを探す．
+        # 範囲ごとに各行を一度だけ走査するので，手間はendからの距離に比例する
+        w = 256
+        hi = end  # これ以降に始まるものは調べた
+        while hi > start:
+            lo = max(start, end - w)
+            found = None  # (-開始, 行の順番, コンパイルした正規表現)
+            if self.literal is not None:
+                i = self.last_start(self.literal, v, lo, hi, end)
+                if i is not None:  # その位置で一致する最初の行が，選ばれた選択肢
+                    for k, c in self.literals:
+                        if c.match(v, i, end):
+                            found = (-i, k, c)
+                            break
+            for k, c in self.patterns:
+                i = self.last_start(c, v, lo, hi, end)
+                if i is not None and (found is None or (-i, k) < found[:2]):
+                    found = (-i, k, c)
+            if found is not None:
+                m = found[2].match(v, -found[0], end)
+                return [m.start(), m.end(), self.rows[found[1]]]
+            hi = lo
+            w *= 4
+        return None
+
+    @staticmethod
+    def last_start(c, v, lo, hi, end):
+        # cがloからhiまでに始まる最後の位置．重なるものも数える．なければNone
+        last = None
+        pos = lo
+        while pos < hi:
+            m = c.search(v, pos, end)
+            if m is None or m.start() >= hi:
+                break
+            last = m.start()
+            pos = last + 1
+        return last
+
+
+files_task = None  # プロセスプールの各プロセスで使う(FindEngine, 置換の設定)
+
+
+def init_files_task(languages, rows, cols, ignore_case, replace, opened, cancelled):
+    # 新しく起動したプロセスで，必要なものは全て引数で受け取る．
+    # replaceはNone(検索)，"preview"(差分を返すだけ)，"write"(書き換える)のどれか．
+    # openedはエディタで開いているファイル，cancelledは中止を知らせるEvent
+    global files_task
+    install_translation(languages)
+    col_re, col_find, col_replace = cols
+    files_task = (
+        FindEngine(rows, col_re, col_find, ignore_case),
+        col_re,
+        col_replace,
+        replace,
+        opened,
+        cancelled,
+    )
 
 
-###########################################################################
-## Class DialogFind
-###########################################################################
+def find_in_file(path, max_lines=1000):
+    # プロセスプールで実行して，(path, 見つかった数, 表示する文字列)を返す．
+    # 読めないファイルは見つかった数をNoneにして，理由を返す
+    engine, col_re, col_replace, replace, opened, cancelled = files_task
+    if cancelled.is_set():  # 残りは調べずに，書き換え中のものが終わるのを待たせる
+        return path, 0, ""
+    if replace is not None and opened and os.path.realpath(path) == opened:
+        # 書き換えても，エディタで保存すると元に戻ってしまう
+        return path, None, _("エディタで開いているので置換しません")
+    try:
+        v, char_code, return_code, mixed = read_text(path)
+        if replace is None:
+            r = []
+            n = 0
+            line = 0  # startまでの改行の数
+            pos = 0
+            last = -1  # 最後に表示した行
+            for start, end, k, m in engine.matches(v):
+                n += 1
+                line += v.count("\n", pos, start)
+                pos = start
+                if line != last and len(r) < max_lines:
+                    last = line
+                    s = v.rfind("\n", 0, start) + 1
+                    e = v.find("\n", start)
+                    r.append("{}: {}\n".format(line + 1, v[s : len(v) if e < 0 else e]))
+            if n > len(r) and len(r) == max_lines:
+                r.append(_("他にもあります") + "\n")
+            return path, n, "".join(r)
+        new, n = engine.replace_all_n(v, col_replace, col_re)
+        if n == 0 or new == v:
+            return path, 0, ""
+        if mixed:  # 書き換えると，置換していない所の改行コードも変わってしまう
+            return path, None, _("改行コードが混在しているので置換しません")
+        if replace == "preview":
+            return (
+                path,
+                n,
+                "".join(
+                    difflib.unified_diff(
+                        v.splitlines(True), new.splitlines(True), path, path
+                    )
+                ),
+            )
+        if cancelled.is_set():
+            return path, 0, ""
+        save_text(path, [new], char_code, return_code)
+        return path, n, ""
+    except (IOError, OSError, ValueError) as e:  # UnicodeErrorはValueErrorの一種
+        return path, None, str(e)
 
 
 class DialogFind(wx.Dialog):
+    highlight_limit = 20000  # これより多く見つかった分は，数だけ知らせる
+    highlight_batch = 1000  # 見えていない所は，これだけずつ後で色を付ける
+    results_limit = 1000000  # 結果の欄がこれより長くなったら，数だけ数える
     colors = (
         (255, 0, 0),  # red
         (0, 0, 255),  # blue
@@ -2133,7 +4063,7 @@ class DialogFind(wx.Dialog):
             id=wx.ID_ANY,
             title=_("検索／置換"),
             pos=wx.DefaultPosition,
-            size=wx.Size(600, 360),
+            size=wx.Size(600, 640),
             style=wx.DEFAULT_DIALOG_STYLE | wx.MINIMIZE_BOX | wx.RESIZE_BORDER,
         )
         self.SetSizeHints(wx.DefaultSize, wx.DefaultSize)
@@ -2280,6 +4210,11 @@ class DialogFind(wx.Dialog):
         self.button_clear.SetToolTip(_("背景色を消します"))
         bSizer2.Add(self.button_clear, 0, wx.ALIGN_CENTER_VERTICAL | wx.ALL, 5)
 
+        self.staticText_found = wx.StaticText(
+            self, wx.ID_ANY, "", wx.DefaultPosition, wx.DefaultSize, 0
+        )
+        bSizer2.Add(self.staticText_found, 0, wx.ALIGN_CENTER_VERTICAL | wx.ALL, 5)
+
         bSizer2.Add((0, 0), 1, wx.EXPAND, 5)
 
         self.checkBox_ignore_case = wx.CheckBox(
@@ -2338,6 +4273,136 @@ class DialogFind(wx.Dialog):
 
         bSizer1.Add(bSizer2, 0, wx.EXPAND, 5)
 
+        bSizer2 = wx.BoxSizer(wx.HORIZONTAL)
+
+        staticText1 = wx.StaticText(
+            self, wx.ID_ANY, _("フォルダ："), wx.DefaultPosition, wx.DefaultSize, 0
+        )
+        staticText1.Wrap(-1)
+        bSizer2.Add(
+            staticText1, 0, wx.ALIGN_CENTER_VERTICAL | wx.TOP | wx.BOTTOM | wx.LEFT, 5
+        )
+
+        self.dirPicker = wx.DirPickerCtrl(
+            self,
+            wx.ID_ANY,
+            wx.EmptyString,
+            _("フォルダを選ぶ"),
+            wx.DefaultPosition,
+            wx.DefaultSize,
+            wx.DIRP_USE_TEXTCTRL | wx.DIRP_DIR_MUST_EXIST,
+        )
+        bSizer2.Add(
+            self.dirPicker,
+            1,
+            wx.ALIGN_CENTER_VERTICAL | wx.TOP | wx.BOTTOM | wx.RIGHT,
+            5,
+        )
+
+        bSizer1.Add(bSizer2, 0, wx.EXPAND, 5)
+
+        bSizer2 = wx.BoxSizer(wx.HORIZONTAL)
+
+        staticText1 = wx.StaticText(
+            self, wx.ID_ANY, _("対象："), wx.DefaultPosition, wx.DefaultSize, 0
+        )
+        staticText1.Wrap(-1)
+        bSizer2.Add(
+            staticText1, 0, wx.ALIGN_CENTER_VERTICAL | wx.TOP | wx.BOTTOM | wx.LEFT, 5
+        )
+
+        self.textCtrl_include = wx.TextCtrl(
+            self, wx.ID_ANY, "*", wx.DefaultPosition, wx.DefaultSize, 0
+        )
+        self.textCtrl_include.SetToolTip(
+            _(
+                "空白で区切って複数指定できます．"
+                "ファイル名か，フォルダからの相対パスと比べます．例: system/* 0/*"
+            )
+        )
+        bSizer2.Add(
+            self.textCtrl_include,
+            1,
+            wx.ALIGN_CENTER_VERTICAL | wx.TOP | wx.BOTTOM | wx.RIGHT,
+            5,
+        )
+
+        staticText1 = wx.StaticText(
+            self, wx.ID_ANY, _("除外："), wx.DefaultPosition, wx.DefaultSize, 0
+        )
+        staticText1.Wrap(-1)
+        bSizer2.Add(
+            staticText1, 0, wx.ALIGN_CENTER_VERTICAL | wx.TOP | wx.BOTTOM | wx.LEFT, 5
+        )
+
+        self.textCtrl_exclude = wx.TextCtrl(
+            self,
+            wx.ID_ANY,
+            ".* *.gz processor* postProcessing",
+            wx.DefaultPosition,
+            wx.DefaultSize,
+            0,
+        )
+        self.textCtrl_exclude.SetToolTip(_("当てはまるフォルダの中は調べません．"))
+        bSizer2.Add(
+            self.textCtrl_exclude,
+            1,
+            wx.ALIGN_CENTER_VERTICAL | wx.TOP | wx.BOTTOM | wx.RIGHT,
+            5,
+        )
+
+        bSizer1.Add(bSizer2, 0, wx.EXPAND, 5)
+
+        bSizer2 = wx.BoxSizer(wx.HORIZONTAL)
+
+        self.button_find_files = wx.Button(
+            self, wx.ID_ANY, _("ファイルから検索"), wx.DefaultPosition, wx.DefaultSize, 0
+        )
+        bSizer2.Add(self.button_find_files, 0, wx.ALIGN_CENTER_VERTICAL | wx.ALL, 5)
+
+        self.button_rep_files = wx.Button(
+            self, wx.ID_ANY, _("ファイル内を置換"), wx.DefaultPosition, wx.DefaultSize, 0
+        )
+        self.button_rep_files.SetToolTip(
+            _("差分を見るだけの場合，ファイルは書き換えません．")
+        )
+        bSizer2.Add(self.button_rep_files, 0, wx.ALIGN_CENTER_VERTICAL | wx.ALL, 5)
+
+        self.checkBox_preview = wx.CheckBox(
+            self,
+            wx.ID_ANY,
+            _("差分を見るだけ"),
+            wx.DefaultPosition,
+            wx.DefaultSize,
+            0,
+        )
+        self.checkBox_preview.SetValue(True)
+        bSizer2.Add(self.checkBox_preview, 0, wx.ALIGN_CENTER_VERTICAL | wx.ALL, 5)
+
+        self.button_stop_files = wx.Button(
+            self, wx.ID_ANY, _("中止"), wx.DefaultPosition, wx.DefaultSize, 0
+        )
+        bSizer2.Add(self.button_stop_files, 0, wx.ALIGN_CENTER_VERTICAL | wx.ALL, 5)
+
+        self.staticText_files = wx.StaticText(
+            self, wx.ID_ANY, "", wx.DefaultPosition, wx.DefaultSize, 0
+        )
+        bSizer2.Add(self.staticText_files, 0, wx.ALIGN_CENTER_VERTICAL | wx.ALL, 5)
+
+        bSizer1.Add(bSizer2, 0, wx.EXPAND, 5)
+
+        self.textCtrl_results = wx.TextCtrl(
+            self,
+            wx.ID_ANY,
+            wx.EmptyString,
+            wx.DefaultPosition,
+            wx.DefaultSize,
+            wx.TE_MULTILINE | wx.TE_READONLY | wx.TE_DONTWRAP,
+        )
+        if font is not None:
+            self.textCtrl_results.SetFont(font)
+        bSizer1.Add(self.textCtrl_results, 1, wx.EXPAND | wx.ALL, 5)
+
         self.SetSizer(bSizer1)
         self.Layout()
 
@@ -2369,9 +4434,21 @@ class DialogFind(wx.Dialog):
         self.button_find_next.Bind(wx.EVT_BUTTON, self.button_find_nextOnButtonClick)
         self.button_replace.Bind(wx.EVT_BUTTON, self.button_replaceOnButtonClick)
         self.button_rep_find.Bind(wx.EVT_BUTTON, self.button_rep_findOnButtonClick)
+        self.button_find_files.Bind(wx.EVT_BUTTON, self.button_find_filesOnButtonClick)
+        self.button_rep_files.Bind(wx.EVT_BUTTON, self.button_rep_filesOnButtonClick)
+        self.button_stop_files.Bind(wx.EVT_BUTTON, self.button_stop_filesOnButtonClick)
+        self.Bind(wx.EVT_CLOSE, self.DialogFindOnClose)
 
         self.target = target
         self.found = None
+        self.engine = None
+        self.engine_key = None
+        self.highlighting = None  # 色付け中の印
+        self.searching_files = None  # ファイルを検索中の印
+        self.files_cancelled = None  # ファイルの検索を中止するEvent
+        self.files_thread = None  # プロセスプールを使うスレッド
+        self.get_target_path = None  # 編集中のファイルのパスを返す．FrameMainが設定する
+        self.files_found = [0, 0, 0]  # 調べたファイル，見つかったファイル，見つかった数
 
     def button_invert_activeOnButtonClick(self, event):
         t = self.grid_find.table
@@ -2453,74 +4530,55 @@ class DialogFind(wx.Dialog):
 
     def button_colorizeOnButtonClick(self, event):
 #        self.target.reset_styles()
-        v = self.target.GetValue()
-        n = 0
+        v = self.target.text.get_value()
         found = []
-        for i in self.grid_find.table.data:
-            if (
-                not i[self.grid_find.table.COL_ACTIVE]
-                or i[self.grid_find.table.COL_FIND] is None
-            ):
-                continue
-            if i[self.grid_find.table.COL_RE]:
-                m = re.search(i[self.grid_find.table.COL_FIND], v)
-                if m:
-                    found.append([m.start(), m.end(), i, n])
-                    n += 1
+        count = 0
+        for start, end, k, m in self.find_engine().matches(v):
+            count += 1
+            if len(found) < self.highlight_limit:
+                found.append([start, end, k])
+        # 見つかった行の順に色を変え，同じ色が続くところはまとめる
+        rows = sorted(set(i[2] for i in found))
+        colors = dict((k, j % len(self.colors)) for j, k in enumerate(rows))
+        spans = []
+        for start, end, k in found:
+            if len(spans) > 0 and spans[-1][1] == start and spans[-1][2] == colors[k]:
+                spans[-1][1] = end
             else:
-                m = (
-                    v.lower().find(i[self.grid_find.table.COL_FIND].lower())
-                    if self.checkBox_ignore_case.GetValue()
-                    else v.find(i[self.grid_find.table.COL_FIND])
-                )
-                if m != -1:
-                    found.append([m, m + len(i[self.grid_find.table.COL_FIND]), i, n])
-                    n += 1
-        shift = 0
-        while len(found) > 0:
-            found.sort(key=lambda x: (x[0], x[3]))
-            start, end, i, n = found[0][0], found[0][1], found[0][2], found[0][3]
-            j = n % len(self.colors)
-            self.target.SetStyle(
-                shift + start,
-                shift + end,
-                wx.TextAttr(
-                    wx.BLACK,
-                    wx.Colour(
-                        self.colors[j][0], self.colors[j][1], self.colors[j][2], 110
-                    ),
-                ),
+                spans.append([start, end, colors[k]])
+        # 見えている所を先に色付けし，残りは後で少しずつ行う
+        a, b = self.target.visible_range()
+        i = bisect.bisect_left([j[1] for j in spans], a)
+        j = bisect.bisect_right([j[0] for j in spans], b, i)
+        self.highlighting = token = object()
+        self.highlight(token, len(v), spans[i:j])
+        rest = spans[j:] + spans[:i]
+        for i in range(0, len(rest), self.highlight_batch):
+            wx.CallAfter(
+                self.highlight, token, len(v), rest[i : i + self.highlight_batch]
             )
-            v = v[end:]
-            shift += end
-            refind = []
-            for j in range(len(found)):
-                if found[0][0] < end:
-                    refind.append((found[0][2], found[0][3]))
-                    del found[0]
-                else:
-                    break
-            for j in found:
-                j[0] -= end
-                j[1] -= end
-            for j in refind:
-                i, n = j[0], j[1]
-                if i[self.grid_find.table.COL_RE]:
-                    m = re.search(i[self.grid_find.table.COL_FIND], v)
-                    if m:
-                        found.append([m.start(), m.end(), i, n])
-                else:
-                    m = (
-                        v.lower().find(i[self.grid_find.table.COL_FIND].lower())
-                        if self.checkBox_ignore_case.GetValue()
-                        else v.find(i[self.grid_find.table.COL_FIND])
-                    )
-                    if m != -1:
-                        found.append(
-                            [m, m + len(i[self.grid_find.table.COL_FIND]), i, n]
-                        )
+        if count > len(found):
+            self.staticText_found.SetLabel(
+                _("{}件．他に{}件あります").format(len(found), count - len(found))
+            )
+        else:
+            self.staticText_found.SetLabel(_("{}件").format(count))
+
+    def highlight(self, token, length, spans):
+        # 色付けをやめたか，その後に編集された場合は何もしない
+        if token is not self.highlighting or len(self.target.text) != length:
+            return
+        styles = [
+            wx.TextAttr(wx.BLACK, wx.Colour(c[0], c[1], c[2], 110)) for c in self.colors
+        ]
+        self.target.Freeze()
+        for start, end, j in spans:
+            self.target.SetStyle(start, end, styles[j])
+        self.target.Thaw()
 
     def button_clearOnButtonClick(self, event):
+        self.highlighting = None
+        self.staticText_found.SetLabel("")
         self.target.reset_styles()
 
     def insert_find(self, row, value):
@@ -2547,76 +4605,12 @@ class DialogFind(wx.Dialog):
 
     def button_rep_allOnButtonClick(self, event):
         s = self.target.GetSelection()
-        v0 = (
-            self.target.GetValue() if s[0] == s[1] else self.target.GetStringSelection()
-        )
-        n = 0
-        found = []
-        for i in self.grid_find.table.data:
-            if (
-                not i[self.grid_find.table.COL_ACTIVE]
-                or i[self.grid_find.table.COL_FIND] is None
-            ):
-                continue
-            if i[self.grid_find.table.COL_RE]:
-                m = re.search(i[self.grid_find.table.COL_FIND], v0)
-                if m:
-                    found.append([m.start(), m.end(), i, n])
-                    n += 1
-            else:
-                m = (
-                    v0.lower().find(i[self.grid_find.table.COL_FIND].lower())
-                    if self.checkBox_ignore_case.GetValue()
-                    else v0.find(i[self.grid_find.table.COL_FIND])
-                )
-                if m != -1:
-                    found.append([m, m + len(i[self.grid_find.table.COL_FIND]), i, n])
-                    n += 1
-        v1 = ""
-        while len(found) > 0:
-            found.sort(key=lambda x: (x[0], x[3]))
-            start, end, i = found[0][0], found[0][1], found[0][2]
-            if i[self.grid_find.table.COL_RE]:
-                v1 += v0[:start] + re.sub(
-                    i[self.grid_find.table.COL_FIND],
-                    ""
-                    if i[self.grid_find.table.COL_REPLACE] is None
-                    else i[self.grid_find.table.COL_REPLACE],
-                    v0[start:end],
-                )
-            else:
-                if i[self.grid_find.table.COL_REPLACE] is None:
-                    v1 += v0[:start]
-                else:
-                    v1 += v0[:start] + i[self.grid_find.table.COL_REPLACE]
-            v0 = v0[end:]
-            refind = []
-            for j in range(len(found)):
-                if found[0][0] < end:
-                    refind.append((found[0][2], found[0][3]))
-                    del found[0]
-                else:
-                    break
-            for j in found:
-                j[0] -= end
-                j[1] -= end
-            for j in refind:
-                i, n = j[0], j[1]
-                if i[self.grid_find.table.COL_RE]:
-                    m = re.search(i[self.grid_find.table.COL_FIND], v0)
-                    if m:
-                        found.append([m.start(), m.end(), i, n])
-                else:
-                    m = (
-                        v0.lower().find(i[self.grid_find.table.COL_FIND].lower())
-                        if self.checkBox_ignore_case.GetValue()
-                        else v0.find(i[self.grid_find.table.COL_FIND])
-                    )
-                    if m != -1:
-                        found.append(
-                            [m, m + len(i[self.grid_find.table.COL_FIND]), i, n]
-                        )
-        v1 += v0
+        if s[0] == s[1]:
+            v0 = self.target.text.get_value()
+        else:
+            v0 = self.target.text[s[0] : s[1]]
+        t = self.grid_find.table
+        v1 = self.find_engine().replace_all(v0, t.COL_REPLACE, t.COL_RE)
         if s[0] == s[1]:
             self.target.SetValue(v1)
             self.target.SetInsertionPointEnd()
@@ -2624,67 +4618,40 @@ class DialogFind(wx.Dialog):
             self.target.Replace(s[0], s[1], v1)
             self.target.SetSelection(s[0], s[0] + len(v1))
 
-    def find_prev_between(self, start, end):
-        v = self.target.GetValue()
-        self.found = None
-        for i in self.grid_find.table.data:
-            if (
-                not i[self.grid_find.table.COL_ACTIVE]
-                or i[self.grid_find.table.COL_FIND] is None
-            ):
-                continue
-            if i[self.grid_find.table.COL_RE]:
-                m = re.compile(i[self.grid_find.table.COL_FIND]).search(v, start, end)
-                if m and (self.found is None or m.start() > self.found[0]):
-                    self.found = [m.start(), m.end(), i]
-            else:
-                m = (
-                    v.lower().find(i[self.grid_find.table.COL_FIND].lower(), start, end)
-                    if self.checkBox_ignore_case.GetValue()
-                    else v.find(i[self.grid_find.table.COL_FIND], start, end)
-                )
-                if m != -1 and (self.found is None or m > self.found[0]):
-                    self.found = [m, m + len(i[self.grid_find.table.COL_FIND]), i]
+    def find_engine(self):
+        # 表が変わるまで同じものを使う
+        t = self.grid_find.table
+        rows = [i for i in t.data if i[t.COL_ACTIVE] and i[t.COL_FIND] is not None]
+        key = (
+            self.checkBox_ignore_case.GetValue(),
+            [(id(i), i[t.COL_RE], i[t.COL_FIND]) for i in rows],
+        )
+        if key != self.engine_key:
+            self.engine = FindEngine(rows, t.COL_RE, t.COL_FIND, key[0])
+            self.engine_key = key
+        return self.engine
+
+    def find_prev_before(self, end):
+        self.found = self.find_engine().search_backward(
+            self.target.text.get_value(), end
+        )
 
     def button_find_prevOnButtonClick(self, event):
-        end = self.target.GetInsertionPoint()
-        for start in range(end - 1, -1, -1):
-            self.find_prev_between(start, end)
+        self.find_prev_before(self.target.GetInsertionPoint())
+        if self.found is not None:
+            self.target.SetSelection(self.found[0], self.found[1])
+            self.target.ShowPosition(self.found[0])
+            return
+        elif self.checkBox_rewind.GetValue():
+            self.find_prev_before(self.target.GetLastPosition())
             if self.found is not None:
                 self.target.SetSelection(self.found[0], self.found[1])
                 self.target.ShowPosition(self.found[0])
                 return
-        if self.checkBox_rewind.GetValue():
-            end = self.target.GetLastPosition()
-            for start in range(end - 1, -1, -1):
-                self.find_prev_between(start, end)
-                if self.found is not None:
-                    self.target.SetSelection(self.found[0], self.found[1])
-                    self.target.ShowPosition(self.found[0])
-                    return
         print("\a")  # beep
 
     def find_next_from(self, point):
-        v = self.target.GetValue()
-        self.found = None
-        for i in self.grid_find.table.data:
-            if (
-                not i[self.grid_find.table.COL_ACTIVE]
-                or i[self.grid_find.table.COL_FIND] is None
-            ):
-                continue
-            if i[self.grid_find.table.COL_RE]:
-                m = re.compile(i[self.grid_find.table.COL_FIND]).search(v, point)
-                if m and (self.found is None or m.start() < self.found[0]):
-                    self.found = [m.start(), m.end(), i]
-            else:
-                m = (
-                    v.lower().find(i[self.grid_find.table.COL_FIND].lower(), point)
-                    if self.checkBox_ignore_case.GetValue()
-                    else v.find(i[self.grid_find.table.COL_FIND], point)
-                )
-                if m != -1 and (self.found is None or m < self.found[0]):
-                    self.found = [m, m + len(i[self.grid_find.table.COL_FIND]), i]
+        self.found = self.find_engine().search(self.target.text.get_value(), point)
 
     def button_find_nextOnButtonClick(self, event):
         self.find_next_from(self.target.GetSelection()[1])
@@ -2731,6 +4698,149 @@ class DialogFind(wx.Dialog):
         self.button_replaceOnButtonClick(event)
         self.button_find_nextOnButtonClick(event)
 
+    def button_find_filesOnButtonClick(self, event):
+        self.start_files(None)
+
+    def button_rep_filesOnButtonClick(self, event):
+        if self.checkBox_preview.GetValue():
+            self.start_files("preview")
+            return
+        with wx.MessageDialog(
+            self,
+            self.dirPicker.GetPath()
+            + _(" の中のファイルを書き換えます．元に戻せませんが，よろしいですか？"),
+            _("ファイル内を置換"),
+            style=wx.OK | wx.CANCEL | wx.ICON_EXCLAMATION,
+        ) as md:
+            if md.ShowModal() != wx.ID_OK:
+                return
+        self.start_files("write")
+
+    def button_stop_filesOnButtonClick(self, event):
+        if self.searching_files is not None:
+            self.stop_files()
+            self.staticText_files.SetLabel(
+                self.staticText_files.GetLabel() + _("．中止しました")
+            )
+
+    def stop_files(self, wait=False):
+        # 残りのファイルは調べない．waitなら，書き換え中のものが終わってプロセスプールが
+        # 閉じるまで待つ
+        self.searching_files = None
+        if self.files_cancelled is not None:
+            self.files_cancelled.set()
+        if wait and self.files_thread is not None:
+            self.files_thread.join()
+
+    def DialogFindOnClose(self, event):
+        self.stop_files()
+        event.Skip()
+
+    def start_files(self, replace):
+        top = self.dirPicker.GetPath()
+        t = self.grid_find.table
+        rows = [
+            list(i) for i in t.data if i[t.COL_ACTIVE] and i[t.COL_FIND] is not None
+        ]
+        if not os.path.isdir(top) or len(rows) == 0:
+            print("\a")  # beep
+            return
+        try:  # 正規表現の誤りは，プロセスプールを作る前に知らせる
+            self.find_engine()
+        except re.error as e:
+            with wx.MessageDialog(
+                self,
+                _("{}\n正規表現が正しくありません．").format(e),
+                _("例外発生"),
+                style=wx.ICON_ERROR,
+            ) as md:
+                md.ShowModal()
+            return
+        opened = None if self.get_target_path is None else self.get_target_path()
+        self.stop_files()  # 前の検索は止める
+        # GUIやMaximaのスレッドを持つプロセスをforkすると固まることがあるので，
+        # 新しいプロセスを起動する
+        try:
+            context = multiprocessing.get_context("spawn")
+        except AttributeError:  # python 2
+            context = multiprocessing
+        self.files_cancelled = context.Event()
+        token = self.searching_files = object()
+        self.files_found = [0, 0, 0]
+        self.textCtrl_results.SetValue("")
+        self.staticText_files.SetLabel(_("検索中"))
+        self.files_thread = threading.Thread(
+            target=self.search_files,
+            args=(
+                token,
+                context,
+                top,
+                self.textCtrl_include.GetValue().split(),
+                self.textCtrl_exclude.GetValue().split(),
+                (
+                    languages,
+                    rows,
+                    (t.COL_RE, t.COL_FIND, t.COL_REPLACE),
+                    self.checkBox_ignore_case.GetValue(),
+                    replace,
+                    os.path.realpath(opened) if opened else None,
+                    self.files_cancelled,
+                ),
+            ),
+        )
+        self.files_thread.daemon = True
+        self.files_thread.start()
+
+    def search_files(self, token, context, top, include, exclude, initargs):
+        # 別のスレッドで，プロセスプールが調べ終えたファイルから順にメインスレッドに渡す．
+        # 書き換えの途中で終了させると一時ファイルが残るので，中止しても終わるのを待つ
+        cancelled = initargs[-1]
+        pool = context.Pool(initializer=init_files_task, initargs=initargs)
+        try:
+            for r in pool.imap_unordered(
+                find_in_file,
+                itertools.takewhile(
+                    lambda path: not cancelled.is_set(),
+                    walk_files(top, include, exclude),
+                ),
+            ):
+                if token is not self.searching_files:  # 中止したか，次を始めた
+                    break
+                wx.CallAfter(self.append_files, token, top, r)
+        finally:
+            cancelled.set()
+            pool.close()
+            pool.join()
+        wx.CallAfter(self.finish_files, token)
+
+    def append_files(self, token, top, result):
+        if token is not self.searching_files:
+            return
+        path, n, s = result
+        self.files_found[0] += 1
+        if n is None:  # 読めなかった
+            s = "{}: {}\n".format(os.path.relpath(path, top), s)
+        elif n > 0:
+            self.files_found[1] += 1
+            self.files_found[2] += n
+            s = "{} ({}件)\n".format(os.path.relpath(path, top), n) + s
+        else:
+            s = ""
+        if s != "" and self.textCtrl_results.GetLastPosition() < self.results_limit:
+            self.textCtrl_results.AppendText(s)
+        self.staticText_files.SetLabel(
+            _("{}ファイル中{}ファイルで{}件").format(*self.files_found)
+        )
+
+    def finish_files(self, token):
+        if token is not self.searching_files:
+            return
+        self.searching_files = None
+        self.staticText_files.SetLabel(
+            _("{}ファイル中{}ファイルで{}件").format(*self.files_found)
+            + _("．終わりました")
+        )
+
     def __del__(self):
         pass
 
@@ -2817,7 +4927,15 @@ class FrameMain(wx.Frame):
             5,
         )
 
-        self.char_codes = ("UTF-8", "CP932")
+        self.char_codes = (
+            "UTF-8",
+            "UTF-8-SIG",
+            "UTF-16",
+            "UTF-16-LE",
+            "UTF-16-BE",
+            "CP932",
+            "EUC-JP",
+        )
         self.choice_char_code = wx.Choice(
             self, wx.ID_ANY, wx.DefaultPosition, wx.DefaultSize, self.char_codes, 0
         )
@@ -3359,6 +5477,30 @@ class FrameMain(wx.Frame):
             wx.ITEM_NORMAL,
         )
         self.menu_maxima.Append(self.menuItem_evaluate)
+        self.menuItem_evaluate_all = wx.MenuItem(
+            self.menu_maxima,
+            wx.ID_ANY,
+            _("すべてのブロックを評価") + "\tShift+Ctrl+Enter",
+            wx.EmptyString,
+            wx.ITEM_NORMAL,
+        )
+        self.menu_maxima.Append(self.menuItem_evaluate_all)
+        self.menuItem_reevaluate_stale = wx.MenuItem(
+            self.menu_maxima,
+            wx.ID_ANY,
+            _("変更されたブロックを再評価") + "\tShift+Ctrl+R",
+            wx.EmptyString,
+            wx.ITEM_NORMAL,
+        )
+        self.menu_maxima.Append(self.menuItem_reevaluate_stale)
+        self.menuItem_cancel_evaluation = wx.MenuItem(
+            self.menu_maxima,
+            wx.ID_ANY,
+            _("評価を中断") + "\tCtrl+.",
+            wx.EmptyString,
+            wx.ITEM_NORMAL,
+        )
+        self.menu_maxima.Append(self.menuItem_cancel_evaluation)
         self.menu_maxima.AppendSeparator()
         self.menuItem_negative = wx.MenuItem(
             self.menu_maxima,
@@ -3406,6 +5548,14 @@ class FrameMain(wx.Frame):
             self.menu_maxima, wx.ID_ANY, _("リセット"), wx.EmptyString, wx.ITEM_NORMAL
         )
         self.menu_maxima.Append(self.menuItem_reset_maxima)
+        self.menuItem_maxima_cache = wx.MenuItem(
+            self.menu_maxima,
+            wx.ID_ANY,
+            _("計算結果をファイルに保存"),
+            wx.EmptyString,
+            wx.ITEM_CHECK,
+        )
+        self.menu_maxima.Append(self.menuItem_maxima_cache)
         self.menubar.Append(self.menu_maxima, "Maxima(&M)")
 
         self.menu_python = wx.Menu()
@@ -3789,6 +5939,12 @@ class FrameMain(wx.Frame):
 
         self.SetMenuBar(self.menubar)
 
+        self.statusBar = self.CreateStatusBar(2, wx.STB_SIZEGRIP, wx.ID_ANY)
+        self.textCtrl_edit.maxima.on_status = self.OnMaximaStatus
+        self.OnMaximaStatus(self.textCtrl_edit.maxima.status)
+        self.textCtrl_edit.on_load_status = self.OnLoadStatus
+        self.textCtrl_edit.on_loaded = self.OnLoaded
+
         # Connect Events
         self.Bind(wx.EVT_CLOSE, self.FrameMainOnClose)
         self.filePicker.Bind(wx.EVT_FILEPICKER_CHANGED, self.OnFileChanged)
@@ -3993,6 +6149,21 @@ class FrameMain(wx.Frame):
             self.menuItem_evaluateOnMenuSelection,
             id=self.menuItem_evaluate.GetId(),
         )
+        self.Bind(
+            wx.EVT_MENU,
+            self.menuItem_evaluate_allOnMenuSelection,
+            id=self.menuItem_evaluate_all.GetId(),
+        )
+        self.Bind(
+            wx.EVT_MENU,
+            self.menuItem_reevaluate_staleOnMenuSelection,
+            id=self.menuItem_reevaluate_stale.GetId(),
+        )
+        self.Bind(
+            wx.EVT_MENU,
+            self.menuItem_cancel_evaluationOnMenuSelection,
+            id=self.menuItem_cancel_evaluation.GetId(),
+        )
         self.Bind(
             wx.EVT_MENU,
             self.menuItem_negativeOnMenuSelection,
@@ -4293,12 +6464,22 @@ class FrameMain(wx.Frame):
         else:
             backup = {}
         backup.setdefault("find_data", None)
+        backup.setdefault("maxima_cache", False)
+        backup.setdefault("undo_budget", self.textCtrl_edit.undo_budget)
+        self.textCtrl_edit.undo_budget = backup["undo_budget"]
+        self.cache_path = os.path.join(
+            os.path.dirname(self.backup_path), "cache_texteditwx.txt"
+        )  # unicode
+        self.menuItem_maxima_cache.Check(backup["maxima_cache"])
+        if backup["maxima_cache"] and os.path.isfile(self.cache_path):
+            self.textCtrl_edit.maxima.load_cache(self.cache_path)
         self.cwd = correct_file_name_in_unicode(
             decode_if_necessary(os.getcwd())
         )  # unicode
         self.filePicker.SetInitialDirectory(self.cwd)
 
         self.dialog_find = DialogFind(self.textCtrl_edit, font, backup["find_data"])
+        self.dialog_find.get_target_path = self.filePicker.GetPath
         self.textCtrl_edit.SetFocus()
         if sys.platform != "darwin":
             locale.setlocale(
@@ -4321,6 +6502,12 @@ class FrameMain(wx.Frame):
         else:
             backup = {}
         backup["find_data"] = self.dialog_find.grid_find.table.DataString()
+        backup["maxima_cache"] = self.menuItem_maxima_cache.IsChecked()
+        backup["undo_budget"] = self.textCtrl_edit.undo_budget
+        if backup["maxima_cache"]:
+            self.textCtrl_edit.maxima.save_cache(self.cache_path)
+        elif os.path.isfile(self.cache_path):
+            os.remove(self.cache_path)
         with codecs.open(self.backup_path, "w", encoding="UTF-8") as f:
             for k, v in backup.items():
                 f.write("'{}': {},\n".format(k, v))
@@ -4341,8 +6528,20 @@ class FrameMain(wx.Frame):
                 self.menuItem_saveOnMenuSelection(None)
             elif r == wx.ID_CANCEL:
                 return
+        self.dialog_find.stop_files(wait=True)  # 書き換え中のファイルを壊さない
         quit()
 
+    def OnMaximaStatus(self, status):
+        self.statusBar.SetStatusText("Maxima: " + status)
+
+    def OnLoadStatus(self, status):
+        self.statusBar.SetStatusText(status, 1)
+
+    def OnLoaded(self, char_code, return_code):
+        # 先頭から推定した文字コードが途中で違うと分かった場合
+        self.choice_char_code.SetSelection(self.char_codes.index(char_code))
+        self.choice_return_code.SetSelection(self.return_codes.index(return_code))
+
     def OnFileChanged(self, event):
         p = correct_file_name_in_unicode(event.GetEventObject().GetPath())  # unicode
         event.GetEventObject().SetPath(p)
@@ -4386,18 +6585,25 @@ class FrameMain(wx.Frame):
             self.load_doc(fd.GetPath())
 
     def save_commands(self, path):
+        if self.textCtrl_edit.loading is not None:  # 読み込み途中のものを保存しない
+            with wx.MessageDialog(
+                self, _("ファイルを読み込み中です．"), _("保存できません"), style=wx.ICON_ERROR
+            ) as md:
+                md.ShowModal()
+            return
         self.save_backup()
         path = correct_file_name_in_unicode(path)  # unicode
-        with codecs.open(
-            path, "wb", encoding=self.char_codes[self.choice_char_code.GetSelection()]
-        ) as f:
-            v = self.textCtrl_edit.GetValue()
-            return_code = self.return_codes[self.choice_return_code.GetSelection()]
-            if return_code == "CR+LF":
-                v = v.replace("\n", "\r\n")
-            elif return_code == "CR":
-                v = v.replace("\n", "\r")
-            f.write(v)
+        text = self.textCtrl_edit.text
+        if len(text) == self.textCtrl_edit.GetLastPosition():
+            chunks = text.chunks  # 全体をつなげずに書き出す
+        else:  # 写しが食い違っていたら，表示されている内容を保存する
+            chunks = [self.textCtrl_edit.GetValue()]
+        save_text(
+            path,
+            chunks,
+            self.char_codes[self.choice_char_code.GetSelection()],
+            self.return_codes[self.choice_return_code.GetSelection()],
+        )
         # self.textCtrl_edit.SaveFile(path) used in windows includes CR in return codes
         self.filePicker.SetPath(path)
         self.textCtrl_edit.SetModified(False)
@@ -4526,7 +6732,12 @@ class FrameMain(wx.Frame):
         self.textCtrl_edit.line_numbered(head=True, prefix="", suffix=": ")
 
     def menuItem_bracketOnMenuSelection(self, event):
-        self.textCtrl_edit.select_bracket((("(", ")"), ("{", "}"), ("[", "]")))
+        self.textCtrl_edit.select_bracket(
+            parentheses=(("(", ")"), ("{", "}"), ("[", "]")),
+            literals=('"', '"'),
+            literal_escape="\\",
+            line_comments=("//",),
+        )
 
     def menuItem_completionOnMenuSelection(self, event):
         if self.textCtrl_edit.HasFocus():
@@ -4586,6 +6797,15 @@ class FrameMain(wx.Frame):
     def menuItem_evaluateOnMenuSelection(self, event):
         self.textCtrl_edit.send_commands_to_maxima()
 
+    def menuItem_evaluate_allOnMenuSelection(self, event):
+        self.textCtrl_edit.evaluate_all_blocks()
+
+    def menuItem_reevaluate_staleOnMenuSelection(self, event):
+        self.textCtrl_edit.reevaluate_stale_blocks()
+
+    def menuItem_cancel_evaluationOnMenuSelection(self, event):
+        self.textCtrl_edit.cancel_maxima()
+
     def menuItem_negativeOnMenuSelection(self, event):
         self.textCtrl_edit.set_negative()
 